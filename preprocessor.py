@@ -1,20 +1,115 @@
 import re
+import os
 import os.path
 import io
+import mmap
+import codecs
+import locale
+import json
+import time
+import pickle
+import asyncio
+import zipfile
+import array
+import bisect
+import hashlib
+import tempfile
+import operator
+import itertools
+import collections
+import concurrent.futures
 
 IF_STATE_NOW  = 0
 IF_STATE_SEEK = 1
 IF_STATE_SKIP = 2
 
+EXPANSION_ENGINE_TOKEN  = "token"
+EXPANSION_ENGINE_STRING = "string"
+
+# Operations in the compiled body of a macro using the # or ## operators
+OPERATION_LITERAL   = 0
+OPERATION_ARGUMENT  = 1
+OPERATION_OPERAND   = 2
+OPERATION_STRINGIFY = 3
+OPERATION_PASTE     = 4
+
+# Deferred lines share the macro table as it was when they were read. Before the table is modified, it is copied if
+# it holds no more than this many macros per deferred line sharing it. Otherwise the lines are expanded immediately.
+DEFERRED_COPY_RATIO = 64
+
+# Gaps in the output of up to this many lines are filled with blank lines rather than a linemarker, as gcc does
+MAX_LINE_MARKER_GAP = 8
+
+# Expanded macro bodies longer than this many tokens are not cached. A chain of constants, each defined in terms of
+# the one before, would otherwise cache a number of tokens quadratic in the length of the chain.
+MAX_EXPANDED_BODY_TOKENS = 256
+
+# Methods timed by Preprocessor.enable_profiling(), and the phase they are recorded under
+PROFILE_PHASES = [
+    ("_strip_comments", "strip_comments"),
+    ("_preprocess_directives", "directives"),
+    ("_expand_macros", "expand_macros"),
+    ("_evaluate", "evaluate"),
+]
+
 TOKEN_SEARCH_REGEX = re.compile(r"(\w+)")
+# A line ending in an identifier may be followed by the arguments of a function-like macro on the next line
+TRAILING_TOKEN_REGEX = re.compile(r"\w\s*$")
+# Finds parentheses, skipping over any string and character literals
+PAREN_SCAN_REGEX = re.compile(r"""("(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?)|[()]""")
 PAREN_SEARCH_REGEX = re.compile(r"\s*\(")
+ARGUMENT_DELIMITERS = frozenset(["(", ")", ","])
 VA_ARG_REGEX = re.compile(r"(\w*)(?:(?<!\.))\.\.\.(?:(?!\.))")
 
+DIRECTIVE_KEYWORD_REGEX = re.compile(r"#\s*(\w+)")
+DIRECTIVE_PATTERN_KEYWORD_REGEX = re.compile(r"#\\s\*([A-Za-z_]\w*)(?:\\s|\\\(|\(|\"|\\\"|<|$)")
+
+INCLUDE_CACHE_VERSION = 2
+
+GUARD_OPEN_REGEX = re.compile(r"#\s*(?:ifndef\s+(\w+)|if\s+!\s*defined\s*(?:\(\s*(\w+)\s*\)|\s(\w+)))\s*$")
+GUARD_ELSE_REGEX = re.compile(r"#\s*el(?:se|if)\b")
+
+# Macro table generations are unique across all preprocessors, as macros may be shared between them
+_GENERATIONS = itertools.count()
+
+# Integers in expressions are evaluated as 64 bit values, as for intmax_t and uintmax_t
+INT_MASK = (1 << 64) - 1
+INT_SIGN = 1 << 63
+
+INTEGER_LITERAL_REGEX = re.compile(r"(0[xX][0-9a-fA-F]+|0[bB][01]+|0[0-7]*|[1-9]\d*)([uUlL]*)$")
+FLOAT_LITERAL_REGEX = re.compile(r"(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)[fFlL]?$")
+ESCAPE_REGEX = re.compile(r"\\(x[0-9a-fA-F]+|[0-7]{1,3}|.)", re.DOTALL)
+ESCAPE_CHARS = { "n": "\n", "t": "\t", "r": "\r", "a": "\a", "b": "\b", "f": "\f", "v": "\v", "e": "\x1b" }
+
+# Matches a string or character literal, which may contain // or /*.
+# An unterminated literal is taken to run to the end of the line.
+LITERAL_REGEX = re.compile(r""""[^"\\\n]*(?:\\.[^"\\\n]*)*"?|'[^'\\\n]*(?:\\.[^'\\\n]*)*'?""", re.DOTALL)
+
+# Splits an expression into whitespace, identifiers, numbers, string/char literals and punctuators.
+# Anything unrecognised (such as an unterminated quote) becomes a single character token.
+LEX_TOKEN_REGEX = re.compile(r"""
+      \s+
+    | [^\W\d]\w*
+    | \.?\d(?:[eEpP][+-]|[\w.])*
+    | "(?:[^"\\\n]|\\.)*"
+    | '(?:[^'\\\n]|\\.)*'
+    | \.\.\. | \#\# | <<= | >>= | -> | \+\+ | -- | << | >> | <= | >= | == | != | && | \|\| | [-+*/%&|^]=
+    | .
+    """, re.VERBOSE | re.DOTALL)
+
 class Directive():
-    def __init__(self, pattern, action, conditional = False):
+    # The keyword (such as "define") is used to dispatch lines to the directive.
+    # If not supplied, it is taken from patterns beginning with #\s*<keyword>.
+    # Directives without a keyword are tried against every line.
+    def __init__(self, pattern, action, conditional = False, keyword = None):
         self.pattern = re.compile(pattern)
         self.action = action
         self.conditional = conditional
+        if keyword is None:
+            match = DIRECTIVE_PATTERN_KEYWORD_REGEX.match(pattern)
+            if match:
+                keyword = match.group(1)
+        self.keyword = keyword
 
     def invoke(self, line, parse_enabled):
         # conditional directives must be checked even on disabled parse
@@ -26,10 +121,49 @@ class Directive():
         return False
 
 class Macro():
+    __slots__ = (
+        "token", "expr", "args", "_variadic", "_error", "_tokens", "_template", "_operations", "_expanded_params",
+        "_string_template", "_expanded", "_expanded_generation",
+    )
+
     def __init__(self, token, expr = None, args = None):
         self.token = token
         self.expr = expr if expr else ""
         self.args = args
+        self._variadic = args is not None and any(VA_ARG_REGEX.search(arg) for arg in args)
+        self._error = None
+        self._tokens = None
+        self._template = None
+        self._operations = None
+        self._expanded_params = None
+        self._string_template = None
+
+        # The fully expanded body of an object-like macro, valid for a single macro table generation
+        self._expanded = None
+        self._expanded_generation = None
+
+        if args is not None:
+            try:
+                self._compile()
+            except ValueError as error:
+                # An invalid parameter list is reported when the macro is invoked
+                self._error = error
+        elif "##" in self.expr:
+            # The pasted tokens of an object-like macro never change, so are pasted once
+            self._operations = self._compile_operations(LEX_TOKEN_REGEX.findall(self.expr), {})
+            self._tokens = self._apply_operations([], [])
+            self._operations = None
+
+    # Generations are only unique within a process, so the expanded body is not pickled
+    def __getstate__(self):
+        state = { name: getattr(self, name) for name in Macro.__slots__ }
+        state["_expanded"] = None
+        state["_expanded_generation"] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
     
     def __repr__(self):
         if self.args:
@@ -42,12 +176,209 @@ class Macro():
             return self._substitute_args(self.expr, args)
         return self.expr
 
+    # Expands the macro to a list of tokens.
+    # Arguments must be supplied as lists of tokens. The returned list must not be modified.
+    # If expand_arg is given, it is used to macro expand each argument that is not an operand of # or ##.
+    def expand_tokens(self, args = None, expand_arg = None):
+        if self._tokens is None:
+            self._tokens = LEX_TOKEN_REGEX.findall(self.expr)
+        if not args and self._operations is None:
+            return self._tokens
+        if self._error is not None:
+            raise self._error
+
+        # Map each parameter to its value, the same way _substitute_args does
+        count = len(self.args) - 1 if self._variadic else len(self.args)
+        values = [ self._strip_tokens(arg) for arg in args[:count] ]
+        # parameters without an argument are left in place
+        values.extend([name] for name in self.args[len(values):count])
+        if self._variadic:
+            vtokens = []
+            for i, arg in enumerate(args[count:]):
+                if i:
+                    vtokens.append(",")
+                vtokens.extend(arg)
+            values.append(vtokens)
+
+        expanded = values
+        if expand_arg is not None:
+            expanded = [ expand_arg(value) if i in self._expanded_params else value for i, value in enumerate(values) ]
+        if self._operations is not None:
+            return self._apply_operations(expanded, values)
+
+        head, template = self._template
+        expansion = list(head)
+        for index, literal in template:
+            expansion.extend(expanded[index])
+            expansion.extend(literal)
+        return expansion
+
+    # returns true if the macro accepts variadic arguments
+    def is_variadic(self):
+        return self._variadic
+
+    # Removes leading and trailing whitespace tokens
+    @staticmethod
+    def _strip_tokens(tokens):
+        start = 0
+        end = len(tokens)
+        while start < end and tokens[start].isspace():
+            start += 1
+        while end > start and tokens[end - 1].isspace():
+            end -= 1
+        return tokens[start:end]
+
+    # Validates the parameters, and splits the lexed body into literal tokens and the parameters between them.
+    # The template is the leading literal tokens, and a list of (parameter index, following literal tokens).
+    # Bodies using the # or ## operators are compiled to a list of operations instead.
+    def _compile(self):
+        indices = self._parameter_indices()
+        self._tokens = LEX_TOKEN_REGEX.findall(self.expr)
+        if "#" in self.expr and ("#" in self._tokens or "##" in self._tokens):
+            self._operations = self._compile_operations(self._tokens, indices)
+            self._expanded_params = { value for kind, value in self._operations if kind == OPERATION_ARGUMENT }
+            return
+
+        head = []
+        template = []
+        literal = head
+        for token in self._tokens:
+            index = indices.get(token)
+            if index is None:
+                literal.append(token)
+            else:
+                literal = []
+                template.append((index, literal))
+        self._template = (head, template)
+        self._expanded_params = { index for index, literal in template }
+
+    # Compiles a body using the # and ## operators to a list of (operation, value)
+    def _compile_operations(self, tokens, indices):
+        operations = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            i += 1
+            if token == "#" and indices:
+                # stringify the following parameter
+                j = i
+                while j < len(tokens) and tokens[j].isspace():
+                    j += 1
+                if j < len(tokens) and tokens[j] in indices:
+                    operations.append((OPERATION_STRINGIFY, indices[tokens[j]]))
+                    i = j + 1
+                    continue
+            if token == "##":
+                # whitespace around the operator is not part of either operand
+                while operations and operations[-1][0] == OPERATION_LITERAL and operations[-1][1].isspace():
+                    operations.pop()
+                while i < len(tokens) and tokens[i].isspace():
+                    i += 1
+                operations.append((OPERATION_PASTE, None))
+            elif token in indices:
+                operations.append((OPERATION_ARGUMENT, indices[token]))
+            else:
+                operations.append((OPERATION_LITERAL, token))
+
+        # operands of ## use the argument as written, rather than its expansion
+        for i, (kind, value) in enumerate(operations):
+            if kind == OPERATION_ARGUMENT:
+                if (i > 0 and operations[i - 1][0] == OPERATION_PASTE) or (i + 1 < len(operations) and operations[i + 1][0] == OPERATION_PASTE):
+                    operations[i] = (OPERATION_OPERAND, value)
+        return operations
+
+    # Builds the expansion from the compiled operations, given the expanded and unexpanded argument values
+    def _apply_operations(self, expanded, values):
+        expansion = []
+        paste = False
+        # whether the last operand was an empty argument
+        empty = False
+        for kind, value in self._operations:
+            if kind == OPERATION_PASTE:
+                paste = True
+                continue
+            if kind == OPERATION_LITERAL:
+                tokens = [value]
+            elif kind == OPERATION_ARGUMENT:
+                tokens = expanded[value]
+            elif kind == OPERATION_OPERAND:
+                tokens = values[value]
+            else:
+                tokens = [self._stringify(values[value])]
+
+            if paste:
+                paste = False
+                if not tokens:
+                    # pasting an empty argument leaves the left operand.
+                    # As an extension, a comma pasted with empty variadic arguments is removed.
+                    if self._variadic and value == len(self.args) - 1 and not empty and expansion and expansion[-1] == ",":
+                        expansion.pop()
+                    continue
+                if not empty and expansion:
+                    tokens = LEX_TOKEN_REGEX.findall(expansion.pop() + tokens[0]) + tokens[1:]
+            expansion.extend(tokens)
+            empty = not tokens
+        return expansion
+
+    # Converts an argument to a string literal, as the # operator does
+    @staticmethod
+    def _stringify(tokens):
+        parts = []
+        for token in tokens:
+            if token.isspace():
+                token = " "
+            elif token[0] == "\"" or token[0] == "'":
+                token = token.replace("\\", "\\\\").replace("\"", "\\\"")
+            parts.append(token)
+        return "\"" + "".join(parts).strip() + "\""
+
+    # Maps each name that may be substituted to the index of its parameter
+    def _parameter_indices(self):
+        vname = self._variadic_name()
+        indices = { name: i for i, name in enumerate(self.args) if TOKEN_SEARCH_REGEX.search(name) }
+        if vname:
+            indices[vname] = len(self.args) - 1
+        return indices
+
     # Substitutes any defined arguments in the expression
     # This must be done in a single pass, so that nested tokens are left in place
     def _substitute_args(self, expr, args):
-        # Create a map between the argument name and the value (ignoring possible va_args)
-        tokens = { self.args[i]: args[i].strip() for i in range(len(self.args)) if re.search(TOKEN_SEARCH_REGEX, self.args[i]) }
-
+        if self._error is not None:
+            raise self._error
+        if self._string_template is None:
+            # The string engine substitutes every word, including those within string literals
+            indices = self._parameter_indices()
+            pieces = TOKEN_SEARCH_REGEX.split(expr)
+            head = [pieces[0]]
+            template = []
+            literal = head
+            for i in range(1, len(pieces), 2):
+                index = indices.get(pieces[i])
+                if index is None:
+                    literal.append(pieces[i])
+                else:
+                    literal = []
+                    template.append((index, literal))
+                literal.append(pieces[i + 1])
+            self._string_template = ("".join(head), [ (index, "".join(literal)) for index, literal in template ])
+
+        # Map each parameter to its value (ignoring possible va_args)
+        count = len(self.args) - 1 if self._variadic else len(self.args)
+        values = [ arg.strip() for arg in args[:count] ]
+        values.extend(self.args[len(values):count])
+        if self._variadic:
+            # get all args after all the positional args
+            values.append(",".join(args[count:]))
+
+        head, template = self._string_template
+        parts = [head]
+        for index, literal in template:
+            parts.append(values[index])
+            parts.append(literal)
+        return "".join(parts)
+
+    # Validates the parameter list, and returns the name of the variadic parameter, if any.
+    def _variadic_name(self):
         # NOTE: variadic macros support
         vname = None
         for i in range(len(self.args)):
@@ -62,23 +393,773 @@ class Macro():
             elif re.search(TOKEN_SEARCH_REGEX, self.args[i]) is None:
                 # We got here a malformed parameter (not token-like, not variadic)
                 raise ValueError(f'Invalid parameter: {self.args[i]}')
-            
-        # get all args after all the positional args
-        tokens.update({vname: ','.join(args[len(self.args) - 1:])})
-        
-        def _substitute_token(match):
-            token = match.groups()[0]
-            if token in tokens:
-                return tokens[token]
+        return vname
+
+
+# The defined operator, as a macro for the string expansion engine
+class _DefinedMacro(Macro):
+    __slots__ = ("_preprocessor",)
+
+    def __init__(self, preprocessor):
+        super().__init__("defined", "?", ["token"])
+        self._preprocessor = preprocessor
+
+    def expand(self, args = None):
+        return "1" if self._preprocessor.is_defined(args[0]) else "0"
+
+# A source line whose expansion is deferred, along with the macro table it must be expanded with
+class _DeferredLine():
+    __slots__ = ("text", "macros", "generation")
+
+    def __init__(self, text, macros, generation):
+        self.text = text
+        self.macros = macros
+        self.generation = generation
+
+# A macro name which must never be expanded, as it was found within the expansion of the same macro
+class _PaintedToken(str):
+    __slots__ = ()
+
+# A macro dictionary that records which macros are consulted and modified by each active include cache frame.
+class _MacroTable(dict):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.frames = []
+
+    def get(self, token, default = None):
+        if self.frames:
+            self._consult(token)
+        return dict.get(self, token, default)
+
+    def __contains__(self, token):
+        if self.frames:
+            self._consult(token)
+        return dict.__contains__(self, token)
+
+    def __getitem__(self, token):
+        if self.frames:
+            self._consult(token)
+        return dict.__getitem__(self, token)
+
+    def __setitem__(self, token, macro):
+        for frame in self.frames:
+            frame.written[token] = macro
+        dict.__setitem__(self, token, macro)
+
+    def __delitem__(self, token):
+        for frame in self.frames:
+            frame.written[token] = None
+        dict.__delitem__(self, token)
+
+    # Records the state of a macro on entry to each frame, unless the frame has already modified it
+    def _consult(self, token):
+        if token[:1].isalpha() or token[:1] == "_":
+            for frame in self.frames:
+                if token not in frame.written and token not in frame.consulted:
+                    frame.consulted[token] = dict.get(self, token)
+
+# The recorded effects of including a single file
+class _IncludeFrame():
+    def __init__(self):
+        self.source = []
+        self.consulted = {}
+        self.written = {}
+        self.includes = []
+        self.guards = []
+        self.once_consulted = {}
+        self.once_added = []
+        self.cacheable = True
+
+# Detects the #ifndef <token> / #define <token> / ... / #endif pattern wrapping an entire file.
+class _IncludeGuard():
+    START  = 0
+    OPEN   = 1
+    CLOSED = 2
+    NONE   = 3
+
+    def __init__(self):
+        self.state = self.START
+        self.token = None
+        self.depth = 0
+
+    # Checks a significant line before it is preprocessed
+    def check_line(self, line, depth):
+        if self.state == self.START:
+            match = GUARD_OPEN_REGEX.match(line)
+            if match:
+                self.token = match.group(1) or match.group(2) or match.group(3)
+                self.depth = depth
+                self.state = self.OPEN
             else:
-                return token
-        return TOKEN_SEARCH_REGEX.sub(_substitute_token, expr)
+                self.state = self.NONE
+        elif self.state == self.OPEN:
+            # an #else for the guard means the file is not fully guarded
+            if depth == self.depth + 1 and GUARD_ELSE_REGEX.match(line):
+                self.state = self.NONE
+        elif self.state == self.CLOSED:
+            # content after the closing #endif
+            self.state = self.NONE
+
+    # Checks the #if depth after a line is preprocessed
+    def check_depth(self, depth):
+        if self.state == self.OPEN and depth == self.depth:
+            self.state = self.CLOSED
+
+    # returns the guard token if the whole file was guarded
+    def result(self):
+        return self.token if self.state == self.CLOSED else None
+
+# Stores the results of including files in a directory, so that later includes may replay them.
+# Entries are keyed by the content hash of the file, and validated against the macros it consulted.
+# The least recently used entries are evicted once the directory exceeds max_size bytes.
+class IncludeCache():
+    def __init__(self, directory, max_size = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+
+    # Returns the first stored entry for the key that is accepted by is_valid, or None
+    def lookup(self, key, is_valid):
+        folder = os.path.join(self.directory, key)
+        if os.path.isdir(folder):
+            for name in sorted(os.listdir(folder)):
+                fname = os.path.join(folder, name)
+                try:
+                    with open(fname, "r") as file:
+                        entry = json.load(file)
+                except (OSError, ValueError):
+                    continue
+                if is_valid(entry):
+                    self._touch(fname)
+                    self.hits += 1
+                    return entry
+        self.misses += 1
+        return None
+
+    # Stores an entry under the key, replacing any entry with the same consulted macro state
+    def store(self, key, entry):
+        folder = os.path.join(self.directory, key)
+        os.makedirs(folder, exist_ok = True)
+        data = json.dumps(entry)
+        fingerprint = hashlib.sha1(json.dumps(entry["consulted"], sort_keys = True).encode()).hexdigest()
+        fname = os.path.join(folder, fingerprint + ".json")
+
+        # write to a temporary file first, so that concurrent readers never see a partial entry
+        handle, temp = tempfile.mkstemp(dir = folder, suffix = ".tmp")
+        with os.fdopen(handle, "w") as file:
+            file.write(data)
+        os.replace(temp, fname)
+        self._evict()
+
+    # Removes all entries from the cache
+    def clear(self):
+        for fname in list(self._load_index()):
+            self._remove(fname)
+
+    def _touch(self, fname):
+        index = self._load_index()
+        try:
+            os.utime(fname)
+        except OSError:
+            # removed by another process sharing the cache
+            index.pop(fname, None)
+            return
+        if fname in index:
+            # move the entry to the most recently used end of the index
+            index[fname] = index.pop(fname)
+
+    # Builds an index of all entries, ordered from least to most recently used.
+    # Entries removed by another process while the directory is listed are left out.
+    def _load_index(self):
+        if self._index is None:
+            entries = []
+            if os.path.isdir(self.directory):
+                for key in os.listdir(self.directory):
+                    folder = os.path.join(self.directory, key)
+                    try:
+                        names = os.listdir(folder)
+                    except OSError:
+                        continue
+                    for name in names:
+                        if name.endswith(".json"):
+                            fname = os.path.join(folder, name)
+                            try:
+                                stat = os.stat(fname)
+                            except OSError:
+                                continue
+                            entries.append((stat.st_mtime_ns, fname, stat.st_size))
+            entries.sort()
+            self._index = { fname: size for _, fname, size in entries }
+        return self._index
+
+    # The directory is listed again first, as other processes sharing the cache may have stored entries too
+    def _evict(self):
+        self._index = None
+        index = self._load_index()
+        total = sum(index.values())
+        while total > self.max_size and len(index) > 1:
+            fname = next(iter(index))
+            total -= index[fname]
+            self._remove(fname)
+
+    def _remove(self, fname):
+        self._index.pop(fname, None)
+        try:
+            os.remove(fname)
+            os.rmdir(os.path.dirname(fname))
+        except OSError:
+            pass
+
+
+# Compiles a fully expanded C constant expression into a function returning its value.
+# Integer arithmetic follows C, using 64 bit signed and unsigned values.
+# String literals are also accepted, and may be joined with +.
+class _ExpressionCompiler():
+    BINARY_PRECEDENCE = {
+        "||": 1, "&&": 2, "|": 3, "^": 4, "&": 5,
+        "==": 6, "!=": 6, "<": 7, ">": 7, "<=": 7, ">=": 7,
+        "<<": 8, ">>": 8, "+": 9, "-": 9, "*": 10, "/": 10, "%": 10,
+    }
+    COMPARISONS = { "==", "!=", "<", ">", "<=", ">=" }
+
+    def __init__(self, expr, undefined_value = None):
+        self.expr = expr
+        self.tokens = [ token for token in LEX_TOKEN_REGEX.findall(expr) if not token.isspace() ]
+        self.pos = 0
+        # if set, identifiers left after expansion take this value, as in #if. Otherwise they are an error.
+        self.undefined_value = undefined_value
+
+    def compile(self):
+        function, unsigned = self._parse(0)
+        if self.pos < len(self.tokens):
+            self._error("unexpected \"{}\"".format(self.tokens[self.pos]))
+        return function
+
+    def _error(self, message):
+        raise Exception("{} (in expression \"{}\")".format(message, self.expr.strip()))
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            self._error("unexpected end of expression")
+        self.pos += 1
+        return token
+
+    def _expect(self, token):
+        if self._next() != token:
+            self._error("expected \"{}\"".format(token))
+
+    # Parses operators by precedence climbing. Each node is a function and a flag for unsigned results.
+    def _parse(self, min_precedence):
+        node = self._parse_unary()
+        while True:
+            token = self._peek()
+            if token == "?" and min_precedence == 0:
+                self.pos += 1
+                true_node = self._parse(0)
+                self._expect(":")
+                false_node = self._parse(0)
+                node = self._conditional(node, true_node, false_node)
+                continue
+            precedence = self.BINARY_PRECEDENCE.get(token)
+            if precedence is None or precedence < min_precedence:
+                return node
+            self.pos += 1
+            node = self._binary(token, node, self._parse(precedence + 1))
+
+    def _parse_unary(self):
+        token = self._next()
+        if token in ("-", "+", "~", "!"):
+            return self._unary(token, self._parse_unary())
+        if token == "(":
+            node = self._parse(0)
+            self._expect(")")
+            return node
+        if token[0] == '"':
+            # adjacent string literals are joined
+            value = self._unescape(token[1:-1])
+            while self._peek() and self._peek()[0] == '"':
+                value += self._unescape(self._next()[1:-1])
+            return (lambda: value), False
+        if token[0] == "'":
+            value = 0
+            for char in self._unescape(token[1:-1]):
+                value = (value << 8) | ord(char)
+            return (lambda: value), False
+        if token[0].isdigit() or token[0] == ".":
+            return self._number(token)
+        if token[0].isalpha() or token[0] == "_":
+            return self._identifier(token)
+        self._error("unexpected \"{}\"".format(token))
+
+    def _number(self, token):
+        match = INTEGER_LITERAL_REGEX.match(token)
+        if match:
+            digits, suffix = match.groups()
+            if digits[:2] in ("0x", "0X"):
+                value = int(digits[2:], 16)
+            elif digits[:2] in ("0b", "0B"):
+                value = int(digits[2:], 2)
+            elif digits[0] == "0":
+                value = int(digits, 8)
+            else:
+                value = int(digits)
+            if value > INT_MASK:
+                self._error("integer constant is too large")
+            unsigned = "u" in suffix or "U" in suffix or value >= INT_SIGN
+            return (lambda: value), unsigned
+        match = FLOAT_LITERAL_REGEX.match(token)
+        if match:
+            value = float(match.group(1))
+            return (lambda: value), False
+        self._error("invalid number \"{}\"".format(token))
+
+    def _identifier(self, token):
+        value = self.undefined_value
+        if value is None:
+            expr = self.expr
+            def undefined():
+                raise Exception("undefined identifier \"{}\" (in expression \"{}\")".format(token, expr.strip()))
+            return undefined, False
+        return (lambda: value), False
+
+    def _unary(self, token, node):
+        function, unsigned = node
+        if token == "!":
+            return (lambda: 0 if function() else 1), False
+        if token == "+":
+            return node
+        convert = self._converter(unsigned)
+        if token == "-":
+            return (lambda: convert(-function())), unsigned
+        return (lambda: convert(~function())), unsigned
+
+    def _binary(self, token, left, right):
+        left_function, left_unsigned = left
+        right_function, right_unsigned = right
+        if token == "&&":
+            return (lambda: 1 if left_function() and right_function() else 0), False
+        if token == "||":
+            return (lambda: 1 if left_function() or right_function() else 0), False
+
+        # usual arithmetic conversions. Shifts take the type of the left operand.
+        unsigned = left_unsigned if token in ("<<", ">>") else left_unsigned or right_unsigned
+        function = self.OPERATORS[token]
+        convert = self._converter(unsigned)
+        if token in self.COMPARISONS:
+            if unsigned:
+                return (lambda: 1 if function(convert(left_function()), convert(right_function())) else 0), False
+            return (lambda: 1 if function(left_function(), right_function()) else 0), False
+        return (lambda: convert(function(convert(left_function()), convert(right_function())))), unsigned
+
+    def _conditional(self, condition, true_node, false_node):
+        condition_function = condition[0]
+        true_function, true_unsigned = true_node
+        false_function, false_unsigned = false_node
+        unsigned = true_unsigned or false_unsigned
+        convert = self._converter(unsigned)
+        return (lambda: convert(true_function() if condition_function() else false_function())), unsigned
+
+    # returns a function that wraps integers to the range of the result type
+    @staticmethod
+    def _converter(unsigned):
+        if unsigned:
+            return lambda value: value & INT_MASK if type(value) is int else value
+        return lambda value: ((value + INT_SIGN) & INT_MASK) - INT_SIGN if type(value) is int else value
+
+    @staticmethod
+    def _unescape(text):
+        def replace(match):
+            escape = match.group(1)
+            if escape[0] == "x":
+                return chr(int(escape[1:], 16))
+            if escape[0] in "01234567":
+                return chr(int(escape, 8))
+            return ESCAPE_CHARS.get(escape, escape)
+        return ESCAPE_REGEX.sub(replace, text)
+
+    @staticmethod
+    def _divide(a, b):
+        if type(a) is int and type(b) is int:
+            # C division truncates towards zero
+            quotient = abs(a) // abs(b)
+            return -quotient if (a < 0) != (b < 0) else quotient
+        return a / b
+
+    @staticmethod
+    def _modulo(a, b):
+        if type(a) is int and type(b) is int:
+            return a - b * _ExpressionCompiler._divide(a, b)
+        return a % b
+
+    OPERATORS = {
+        "|": operator.or_, "^": operator.xor, "&": operator.and_,
+        "==": operator.eq, "!=": operator.ne, "<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge,
+        "<<": operator.lshift, ">>": operator.rshift,
+        "+": operator.add, "-": operator.sub, "*": operator.mul,
+        "/": _divide.__func__, "%": _modulo.__func__,
+    }
+
+
+# The default include rule. A module level function, so that it may be pickled.
+def _include_all(name):
+    return True
+
+# The result of preprocessing a single source file in a batch
+class BatchResult():
+    def __init__(self, path, source, macros):
+        self.path = path
+        self.source = source
+        self.macros = macros
+
+    def __repr__(self):
+        return "BatchResult({})".format(self.path)
+
+# Preprocesses a single file in a batch worker, using the configuration from Preprocessor._batch_config()
+def _preprocess_batch_file(config, path):
+    p = Preprocessor()
+    p.include_paths = list(config["include_paths"])
+    p.ignore_missing_includes = config["ignore_missing_includes"]
+    p.include_rule = config["include_rule"]
+    p.expansion_engine = config["expansion_engine"]
+    p.max_macro_expansion_depth = config["max_macro_expansion_depth"]
+    p.encoding = config["encoding"]
+    p.encoding_errors = config["encoding_errors"]
+    p.use_mmap = config["use_mmap"]
+    p.index_directories = config["index_directories"]
+    p.file_provider = config["file_provider"]
+    p.expand_source = config["expand_source"]
+    p.line_markers = config["line_markers"]
+    p.lazy_expansion = config["lazy_expansion"]
+    if config["include_cache"] is not None:
+        p.include_cache = IncludeCache(*config["include_cache"])
+    for token, expr, args in config["macros"]:
+        p.define(token, expr, args)
+    p.include(path)
+    return BatchResult(path, p.source(), dict(p.macros))
+
+
+# Serves files to a Preprocessor from a dict of paths to source text, in place of the filesystem.
+# A provider is assigned to Preprocessor.file_provider. Providers implement exists(path) and open(path), which
+# returns a text file-like object. listdir(directory) may also be implemented, for use with index_directories.
+class DictProvider():
+    def __init__(self, files):
+        self.files = { os.path.normpath(path): text for path, text in files.items() }
+
+    def exists(self, path):
+        return os.path.normpath(path) in self.files
+
+    def open(self, path):
+        return io.StringIO(self.files[os.path.normpath(path)])
+
+    def listdir(self, directory):
+        # top level files are listed under "."
+        directory = os.path.normpath(directory)
+        return [ os.path.basename(path) for path in self.files if os.path.normpath(os.path.dirname(path)) == directory ]
+
+# Serves files to a Preprocessor from a zip archive, without extracting it.
+# Paths are relative to the root of the archive. archive may be a path or a zipfile.ZipFile.
+class ZipProvider():
+    def __init__(self, archive, encoding = "utf-8", errors = "strict"):
+        self.archive = archive if isinstance(archive, zipfile.ZipFile) else zipfile.ZipFile(archive)
+        self.encoding = encoding
+        self.errors = errors
+        # member names of each directory. Top level members are under "."
+        self._index = {}
+        for name in self.archive.namelist():
+            if not name.endswith("/"):
+                directory, name = self._split(name)
+                self._index.setdefault(directory, set()).add(name)
+
+    def _split(self, path):
+        directory, name = os.path.split(os.path.normpath(path))
+        return os.path.normpath(directory), name
+
+    def exists(self, path):
+        directory, name = self._split(path)
+        return name in self._index.get(directory, ())
+
+    def open(self, path):
+        name = os.path.normpath(path).replace(os.sep, "/")
+        return io.TextIOWrapper(self.archive.open(name), encoding = self.encoding, errors = self.errors)
+
+    def listdir(self, directory):
+        return list(self._index.get(os.path.normpath(directory), ()))
+
+    # The archive is opened again when unpickled, so it must have been opened from a path
+    def __getstate__(self):
+        return (self.archive.filename, self.encoding, self.errors)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+# Reads files for Preprocessor.include_async() from a local directory, without blocking the event loop.
+# Other providers need only implement the exists() and read() coroutines. Paths are relative to the directory, if given.
+class AsyncDirectoryProvider():
+    def __init__(self, directory = None, encoding = None, errors = "strict"):
+        self.directory = directory
+        self.encoding = encoding
+        self.errors = errors
+
+    def _path(self, path):
+        return os.path.join(self.directory, path) if self.directory else path
+
+    async def exists(self, path):
+        return await asyncio.get_running_loop().run_in_executor(None, os.path.exists, self._path(path))
+
+    # Returns the text of a file
+    async def read(self, path):
+        return await asyncio.get_running_loop().run_in_executor(None, self._read, self._path(path))
+
+    def _read(self, path):
+        with open(path, "r", encoding = self.encoding, errors = self.errors) as file:
+            return file.read()
+
+# Requests made by Preprocessor._iter_include() during include_async()
+class _ResolveRequest():
+    def __init__(self, name, local_path):
+        self.name = name
+        self.local_path = local_path
+
+class _ReadRequest():
+    def __init__(self, path):
+        self.path = path
+
+
+# Call count and cumulative time for a single profiled item
+class ProfileCounter():
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+
+    def add(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+
+    def __repr__(self):
+        return "{} calls, {:.6f}s".format(self.calls, self.seconds)
+
+# Timing collected by Preprocessor.enable_profiling()
+# The time of a file excludes the files it includes. Other times are inclusive, so the include phase contains
+# the time of all other phases, and the directives phase contains the evaluation of #if expressions.
+class Profile():
+    def __init__(self):
+        self.phases = {}
+        self.files = {}
+        self.macros = {}
+
+    def add_macro(self, token, seconds):
+        counter = self.macros.get(token)
+        if counter is None:
+            counter = self.macros[token] = ProfileCounter()
+        counter.add(seconds)
+
+    # Returns the profile as a table, listing up to limit files and macros by time
+    def report(self, limit = 20):
+        lines = []
+        for title, counters, count in [("phase", self.phases, None), ("file", self.files, limit), ("macro", self.macros, limit)]:
+            lines.append("{:<48} {:>10} {:>12}".format(title, "calls", "seconds"))
+            items = sorted(counters.items(), key = lambda item: item[1].seconds, reverse = True)
+            for name, counter in items[:count]:
+                lines.append("{:<48} {:>10} {:>12.6f}".format(name, counter.calls, counter.seconds))
+            lines.append("")
+        return "\n".join(lines)
+
+
+# Maps the lines of the preprocessed source back to the file and line they were produced from.
+# Assign an instance to Preprocessor.source_map before including files. Lines are numbered from 1.
+# Consecutive output lines from consecutive source lines are stored as a single run, so the map stays compact.
+class SourceMap():
+    def __init__(self):
+        self.paths = []
+        self._path_ids = {}
+        # Each run holds the output line it starts at, the index of its path, and the source line it starts at
+        self._starts = array.array("Q")
+        self._files = array.array("I")
+        self._lines = array.array("I")
+        self.output_lines = 0
+
+    # Records output text, which may span several lines, as being produced from the given source line
+    def add(self, path, line, text):
+        file_id = self._path_ids.get(path)
+        if file_id is None:
+            file_id = self._path_ids[path] = len(self.paths)
+            self.paths.append(path)
+        start = self.output_lines + 1
+        if not self._starts or self._files[-1] != file_id or self._lines[-1] + (start - self._starts[-1]) != line:
+            self._starts.append(start)
+            self._files.append(file_id)
+            self._lines.append(line)
+        self.output_lines += text.count("\n")
+
+    # Returns the path and source line that an output line was produced from, or None if it is out of range
+    def origin(self, line):
+        if line < 1 or line > self.output_lines:
+            return None
+        run = bisect.bisect_right(self._starts, line) - 1
+        return self.paths[self._files[run]], self._lines[run] + line - self._starts[run]
+
+    def __len__(self):
+        return len(self._starts)
+
+
+# A copy of the state of a Preprocessor, taken by Preprocessor.snapshot()
+# The macro table and source lines are shared until they are modified, so taking and restoring a snapshot is cheap.
+# A state may be pickled, provided the include_rule, file_provider and any macro expressions can be pickled.
+class PreprocessorState():
+    def __init__(self, p):
+        self.macros = p.macros
+        self.source_lines = p.source_lines
+        self.content_enabled = p._content_enabled
+        self.enable_stack = list(p._enable_stack)
+        self.local_path = p._local_path
+        self.include_guards = dict(p._include_guards)
+        self.include_once = set(p._include_once)
+        self.include_rule = p.include_rule
+        self.include_paths = list(p.include_paths)
+        self.ignore_missing_includes = p.ignore_missing_includes
+        self.max_macro_expansion_depth = p.max_macro_expansion_depth
+        self.include_cache = p.include_cache
+        self.expansion_engine = p.expansion_engine
+        self.encoding = p.encoding
+        self.encoding_errors = p.encoding_errors
+        self.use_mmap = p.use_mmap
+        self.index_directories = p.index_directories
+        self.file_provider = p.file_provider
+        self.expand_source = p.expand_source
+        self.line_markers = p.line_markers
+        self.marker_path = p._marker_path
+        self.marker_line = p._marker_line
+        self.lazy_expansion = p.lazy_expansion
+
+    # Writes the state to a file
+    def save(self, path):
+        with open(path, "wb") as file:
+            pickle.dump(self, file, pickle.HIGHEST_PROTOCOL)
+
+    # Reads a state written by save()
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+
+# A source file being processed by a Watcher, and the results of its last run
+class _WatchedUnit():
+    def __init__(self, path):
+        self.path = path
+        self.lines = []
+        # modification stamps of every file read, by path. None if the unit must be processed.
+        self.stamps = None
+        # includes that could not be found, as (local path, name). They are searched for again on each update.
+        self.missing = []
+        # the states before and after the unit was processed
+        self.start = None
+        self.state = None
+
+# Keeps the macros and source of a preprocessor up to date as files change.
+# Source files are included in order, starting from the state of the preprocessor when the watcher is created.
+# When a file changes, only the source files that read it are processed again, along with any later
+# source files whose starting macros were changed as a result.
+# Setting an include cache on the preprocessor avoids processing unchanged headers again.
+class Watcher():
+    def __init__(self, preprocessor, paths):
+        self.preprocessor = preprocessor
+        self._base = preprocessor.snapshot()
+        self._base_lines = list(preprocessor.source_lines)
+        self._units = [ _WatchedUnit(path) for path in paths ]
+        self.update()
+
+    # Processes the source files affected by any changes, and returns the paths of those that were processed.
+    def update(self):
+        p = self.preprocessor
+        if any(unit.missing for unit in self._units):
+            # files that could not be found may have been created since
+            p.clear_path_cache()
+        processed = []
+        for i, unit in enumerate(self._units):
+            start = self._units[i - 1].state if i else self._base
+            if not self._unit_changed(unit) and unit.start is not None and self._same_state(start, unit.start):
+                # neither the files read nor the starting state have changed
+                unit.start = start
+                continue
+            self._process(i, start)
+            processed.append(unit.path)
+
+        if processed:
+            p.restore(self._units[-1].state if self._units else self._base)
+            p.source_lines = self._base_lines + [ line for unit in self._units for line in unit.lines ]
+            p._source_shared = False
+        return processed
+
+    # Polls for changes until interrupted, calling callback with the paths processed by each update
+    def watch(self, interval = 0.5, callback = None):
+        while True:
+            processed = self.update()
+            if processed and callback:
+                callback(processed)
+            time.sleep(interval)
+
+    def _unit_changed(self, unit):
+        if unit.stamps is None:
+            return True
+        for path, stamp in unit.stamps.items():
+            if self.preprocessor._file_stamp(path) != stamp:
+                return True
+        for local_path, name in unit.missing:
+            if self.preprocessor._find_path(name, local_path)[1]:
+                return True
+        return False
+
+    def _process(self, index, start):
+        unit = self._units[index]
+        p = self.preprocessor
+        # a unit that fails is processed again on the next update
+        unit.stamps = None
+        unit.start = start
+        p.restore(start)
+        p.source_lines = []
+        p._source_shared = False
+        p._dependencies = { unit.path: [] }
+        p._missing_includes = []
+        try:
+            p.include(unit.path)
+        finally:
+            dependencies = p._dependencies
+            missing = p._missing_includes
+            p._dependencies = None
+            p._missing_includes = None
+        unit.lines = p.source_lines
+        unit.state = p.snapshot()
+        unit.stamps = { path: p._file_stamp(path) for path in dependencies }
+        unit.missing = missing
+
+    # Compares the parts of two states that affect how later files are processed
+    @staticmethod
+    def _same_state(a, b):
+        if a is b:
+            return True
+        if (a.include_guards != b.include_guards or a.include_once != b.include_once
+                or a.content_enabled != b.content_enabled or a.enable_stack != b.enable_stack or a.macros.keys() != b.macros.keys()):
+            return False
+        for token, macro in a.macros.items():
+            other = b.macros[token]
+            if macro is not other and (macro.expr != other.expr or macro.args != other.args):
+                return False
+        return True
 
 
 class Preprocessor():
     def __init__(self):
         
-        self._directives = [
+        self._directive_table = {}
+        self._generic_directives = []
+        directives = [
             # Conditional tokens
             Directive(r"#\s*if\s+(.*)", self._directive_if, True),
             Directive(r"#\s*ifdef\s+(\w+)", self._directive_ifdef, True),
@@ -98,24 +1179,110 @@ class Preprocessor():
             Directive(r"#\s*define\s+(\w+)\(([^\)]*)\)\s*(.*)?", self._directive_define_varidic),
             Directive(r"#\s*define\s+(\w+)\s*(.*)?", self._directive_define),
         ]
+        for directive in directives:
+            self.add_directive(directive)
 
         self._content_enabled = IF_STATE_NOW
         self._enable_stack = []
         self._local_path = ""
+        self._current_path = None
         self._source_prior = None
+        self._include_request = None
+        # Set by include_async()
+        self._async_provider = None
+
+        # Include guard tokens and #pragma once files, by resolved path
+        self._include_guards = {}
+        self._include_once = set()
+        self.skipped_includes = 0
+
+        # Number of lines in inactive #if blocks that were skipped without being parsed
+        self.skipped_lines = 0
+
+        # Number of macros substituted during expansion
+        self.macro_expansions = 0
+
+        # Set by enable_profiling()
+        self.profile = None
+
+        # When set to a dict, each file found by an include is added, mapped to the files it includes
+        self._dependencies = None
+        # When set to a list, each include that could not be found is added, as (local path, name)
+        self._missing_includes = None
 
         # special macro required to make the define statement work
-        self._defined_macro = Macro("defined", "?", ["token"])
-        self._defined_macro.expand = lambda args: "1" if self.is_defined(args[0]) else "0"
+        self._defined_macro = _DefinedMacro(self)
 
         self.macros = {}
-        self.include_rule = lambda name: True
+        # Set while the macro table and source lines are shared with a snapshot, and must be copied before modification
+        self._macros_shared = False
+        self._source_shared = False
+        self.include_rule = _include_all
         self.include_paths = []
         self.ignore_missing_includes = False
 
+        # The locations of included files are cached, see clear_path_cache().
+        # If index_directories is set, files are found by listing each directory once, rather than checking each path.
+        self.index_directories = False
+        # Files are read from the filesystem, unless a provider such as a DictProvider or ZipProvider is assigned
+        self.file_provider = None
+        self.clear_path_cache()
+
         self.source_lines = []
         self.max_macro_expansion_depth = 4096
 
+        # If set, GCC style linemarkers (# 12 "file.h") are emitted wherever the output does not continue
+        # from the previous output line. Short gaps within a file are filled with blank lines instead.
+        # A SourceMap may also be assigned to source_map to record the origin of every output line.
+        # The include cache does not record line numbers, so it is bypassed while either is in use.
+        self.line_markers = False
+        self.source_map = None
+        self._marker_path = None
+        self._marker_line = 0
+
+        # If set, source lines are stored unexpanded, along with a reference to the macros at that point.
+        # Lines are expanded when read through source(), so only the lines that are read are expanded.
+        # Until then, source_lines may hold unexpanded lines. The include cache, line tracking and iter_source() disable this.
+        self.lazy_expansion = False
+        self._deferred_lines = False
+        # The number of iter_source() streams in progress
+        self._streaming = 0
+        # Lines deferred since the macros last changed, which share the current macro table
+        self._deferred_pending = []
+
+        # If cleared, only directives are processed, which is sufficient to collect macros.
+        # Source lines are neither expanded nor stored, and lines that cannot be directives are skipped without being parsed.
+        self.expand_source = True
+
+        # Decoding of files read from disk. The platform default encoding is used if encoding is None.
+        # If use_mmap is set, files are memory mapped and decoded a line at a time.
+        self.encoding = None
+        self.encoding_errors = "strict"
+        self.use_mmap = False
+
+        # An IncludeCache may be assigned to reuse the results of including files from disk
+        self.include_cache = None
+        self._digests = {}
+
+        self._expression_cache = {}
+        self.max_expression_cache_size = 4096
+
+        # Expansions made by expand() and evaluate() are memoized until the macros change.
+        # Modifying macros directly instead of through define() and undefine() requires clear_expansion_cache().
+        self._generation = next(_GENERATIONS)
+        self._expansion_cache = collections.OrderedDict()
+        self._expansion_cache_generation = self._generation
+        self._body_expansion_depth = 0
+        # Sorted macro names, for find_macros()
+        self._macro_index = []
+        self._macro_index_generation = None
+        self.max_expansion_cache_size = 4096
+        self.expansion_cache_hits = 0
+        self.expansion_cache_misses = 0
+
+        # Selects the macro expansion engine. The string engine is kept for comparison.
+        self.expansion_engine = EXPANSION_ENGINE_TOKEN
+
     #
     #      PUBLIC INTERFACE
     #
@@ -126,75 +1293,677 @@ class Preprocessor():
         for path in paths:
             self._add_include_path(path)
 
+    # Registers a directive.
+    # Directives sharing a keyword are tried in the order they are added.
+    def add_directive(self, directive):
+        if directive.keyword is None:
+            self._generic_directives.append(directive)
+        else:
+            self._directive_table.setdefault(directive.keyword, []).append(directive)
+
     # returns the output source file as a string
-    def source(self):
-        return "".join(self.source_lines)
+    # start and end may select a slice of source_lines. If lazy_expansion is set, only the selected lines are expanded.
+    def source(self, start = None, end = None):
+        if self._deferred_lines:
+            if self._source_shared:
+                self.source_lines = list(self.source_lines)
+                self._source_shared = False
+            lines = self.source_lines
+            indices = range(*slice(start, end).indices(len(lines)))
+            for i in indices:
+                if type(lines[i]) is _DeferredLine:
+                    lines[i] = self._expand_deferred_line(lines[i])
+            if len(indices) == len(lines):
+                self._deferred_lines = False
+        if start is None and end is None:
+            return "".join(self.source_lines)
+        return "".join(self.source_lines[start:end])
 
     # Defines a symbol
     def define(self, token, expr = None, args = None):
+        self._unshare_macros()
         self.macros[token] = Macro(token, str(expr), args)
+        self._generation = next(_GENERATIONS)
     
     # Undefines a symbol
     def undefine(self, token):
         if token in self.macros:
+            self._unshare_macros()
             del self.macros[token]
+            self._generation = next(_GENERATIONS)
+
+    # Discards all memoized expansions
+    def clear_expansion_cache(self):
+        self._generation = next(_GENERATIONS)
 
     # returns true if a preprocessor symbol is defined
     def is_defined(self, token):
         return token in self.macros
 
+    # Returns the names of the defined macros beginning with prefix, in sorted order.
+    # If a pattern is given, only names containing a match for the regex are returned.
+    def find_macros(self, prefix = "", pattern = None):
+        names = self._macro_names()
+        start = bisect.bisect_left(names, prefix)
+        if prefix:
+            # the first name after every name beginning with the prefix
+            end = bisect.bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+            names = names[start:end]
+        if pattern is not None:
+            search = re.compile(pattern).search
+            names = [ name for name in names if search(name) ]
+        return names
+
+    # Evaluates each of the given names or expressions, returning a dict of their values.
+    # Any that cannot be evaluated map to the raised exception, rather than it being raised.
+    # Macros referenced by many of the expressions are only expanded once, while the macros are unchanged.
+    def evaluate_all(self, names):
+        values = {}
+        for name in names:
+            try:
+                values[name] = self._evaluate(name)
+            except Exception as e:
+                values[name] = e
+        return values
+
+    # The names of all macros, sorted, and rebuilt whenever the macros change
+    def _macro_names(self):
+        if self._macro_index_generation != self._generation:
+            self._macro_index = sorted(self.macros)
+            self._macro_index_generation = self._generation
+        return self._macro_index
+
     # Consumes a file and preprocesses it.
     # file may be a string literal, or a file-like object, or None
     # If the file is not supplied, the path is used to find the file
     def include(self, path, file = None, may_ignore = False):
+        if self._source_shared:
+            self.source_lines = list(self.source_lines)
+            self._source_shared = False
+        self.source_lines.extend(self._iter_include(path, file, may_ignore))
+
+    # Consumes a file as include() does, reading it and any files it includes from an async file provider.
+    # Other tasks may run on the event loop while files are being fetched, though a preprocessor may only
+    # run one include at a time. The provider defaults to an AsyncDirectoryProvider over the local filesystem.
+    async def include_async(self, path, file = None, may_ignore = False, provider = None):
+        if provider is None:
+            provider = AsyncDirectoryProvider(encoding = self.encoding, errors = self.encoding_errors)
+        if self._source_shared:
+            self.source_lines = list(self.source_lines)
+            self._source_shared = False
+        self._async_provider = provider
+        lines = self._iter_include(path, file, may_ignore)
+        try:
+            value = None
+            while True:
+                try:
+                    line = lines.send(value)
+                except StopIteration:
+                    break
+                value = None
+                if type(line) is _ResolveRequest:
+                    value = await self._resolve_async(provider, line)
+                elif type(line) is _ReadRequest:
+                    value = await provider.read(line.path)
+                else:
+                    self.source_lines.append(line)
+        finally:
+            lines.close()
+            self._async_provider = None
+
+    # Resolves an include in the same order as _search_path(), checking the candidates concurrently
+    async def _resolve_async(self, provider, request):
+        candidates = [ os.path.normpath(os.path.join(request.local_path, request.name)) ]
+        candidates += [ os.path.normpath(os.path.join(dir, request.name)) for dir in self.include_paths ]
+        found = await asyncio.gather(*[ provider.exists(candidate) for candidate in candidates ])
+        for candidate, exists in zip(candidates, found):
+            if exists:
+                return candidate, True
+        return request.name, await provider.exists(request.name)
+
+    # Preprocesses each file independently, starting from the include paths, macros and settings of this preprocessor.
+    # Files are spread over a pool of processes, and a list of BatchResult is returned in the same order as paths.
+    # If an include cache is set, it is shared between the workers. The include_rule and file_provider must be picklable.
+    # This preprocessor is not modified.
+    def preprocess_batch(self, paths, processes = None):
+        config = self._batch_config()
+        if processes == 1:
+            return [ _preprocess_batch_file(config, path) for path in paths ]
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            return list(executor.map(_preprocess_batch_file, [config] * len(paths), paths))
+
+    # Consumes a file, yielding the preprocessed source lines as they are produced.
+    # The lines are not stored in source_lines, so memory use is independent of the size of the source.
+    # Arguments are as for include(). Macros are updated as the source is consumed.
+    def iter_source(self, path, file = None, may_ignore = False):
+        # Lines are expanded as soon as they are yielded, so none are deferred
+        self._streaming += 1
+        try:
+            yield from self._iter_include(path, file, may_ignore)
+        finally:
+            self._streaming -= 1
+
+    # Collects the configuration needed to recreate this preprocessor in a batch worker
+    def _batch_config(self):
+        cache = self.include_cache
+        return {
+            "include_paths": self.include_paths,
+            "ignore_missing_includes": self.ignore_missing_includes,
+            "include_rule": self.include_rule,
+            "expansion_engine": self.expansion_engine,
+            "max_macro_expansion_depth": self.max_macro_expansion_depth,
+            "encoding": self.encoding,
+            "encoding_errors": self.encoding_errors,
+            "use_mmap": self.use_mmap,
+            "index_directories": self.index_directories,
+            "file_provider": self.file_provider,
+            "expand_source": self.expand_source,
+            "line_markers": self.line_markers,
+            "lazy_expansion": self.lazy_expansion,
+            "include_cache": (cache.directory, cache.max_size) if cache is not None else None,
+            "macros": [ (macro.token, macro.expr, macro.args) for macro in self.macros.values() ],
+        }
+
+    #
+    #     FILE PARSING
+    #
+
+    # Finds and preprocesses a file, yielding source lines
+    def _iter_include(self, path, file = None, may_ignore = False):
         if file is None:
             # Use the path for find the correct file
-            path = self._resolve_path(path)
-            if not os.path.exists(path):
+            name = path
+            if self._async_provider is not None:
+                # include_async() resolves the path, as the provider must be awaited
+                path, exists = yield _ResolveRequest(name, self._local_path)
+            else:
+                path, exists = self._find_path(path)
+            if self._dependencies is not None and exists:
+                self._add_dependency(self._current_path, path)
+            if self.include_cache is not None and isinstance(self.macros, _MacroTable):
+                self._record_include(name, True, path)
+            if self._include_skippable(path):
+                self.skipped_includes += 1
+                return
+            if not exists:
+                if self._missing_includes is not None:
+                    self._missing_includes.append((self._local_path, name))
                 if may_ignore:
                     return
                 else:
                     raise Exception("file \"{}\" cannot be found".format(path))
-            file = open(path, "r")
+            if self._async_provider is not None:
+                file = io.StringIO((yield _ReadRequest(path)))
+                yield from self._iter_file(file, path, True)
+                return
+            if self.file_provider is not None:
+                with self.file_provider.open(path) as file:
+                    yield from self._iter_file(file, path, True)
+                return
+            # cache entries must hold the expanded source
+            if self.include_cache is not None and self.expand_source and not self._tracking_lines():
+                yield from self._iter_cached(path)
+                return
+            if self.use_mmap:
+                yield from self._iter_file(self._iter_mapped_lines(path), path, True)
+                return
+            with open(path, "r", encoding = self.encoding, errors = self.encoding_errors) as file:
+                yield from self._iter_file(file, path, True)
+            return
         
         elif type(file) is str:
             # Treat the file as a literal body
             file = io.StringIO(file)
 
         # If the file is not a string, treat it as a file-like object
-        self._include_file(file, path)
+        yield from self._iter_file(file, path)
         file.close()
 
-    #
-    #     FILE PARSING
-    #
-
-    # Includes and processes the source in a file
-    def _include_file(self, file, path):
+    # Reads the lines of a file through a memory map, decoding each line as it is reached.
+    # Newlines are translated in the same way as a file opened in text mode. The encoding must be ASCII compatible.
+    def _iter_mapped_lines(self, path):
+        encoding = self.encoding if self.encoding else locale.getpreferredencoding(False)
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(self.encoding_errors), True)
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                # empty files cannot be mapped
+                return
+            with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                size = len(data)
+                start = 0
+                while start < size:
+                    end = data.find(b"\n", start)
+                    end = size if end < 0 else end + 1
+                    text = decoder.decode(data[start:end], end == size)
+                    start = end
+                    # lone carriage returns are translated into extra line breaks
+                    lines = text.split("\n")
+                    for line in lines[:-1]:
+                        yield line + "\n"
+                    if lines[-1]:
+                        yield lines[-1]
+
+    # Processes the source in a file, yielding source lines
+    # The file may be any iterable of lines, and is consumed lazily
+    # If detect_guard is set, the file is checked for an include guard
+    def _iter_file(self, file, path, detect_guard = False):
 
         # Update the new local path to be relative to the current path.
         prior_local = self._set_local_path(path)
+        prior_path = self._current_path
+        self._current_path = path
         stack_depth = len(self._enable_stack)
+        guard = _IncludeGuard() if detect_guard else None
 
         prior_line = None
         in_comment = False
+        expand_source = self.expand_source
+        tracking = self._tracking_lines()
+        line_start = 1
+        origin = 1
 
-        for line in file.readlines():
-            # do the actual parsing
-            line, prior_line = self._join_escaped_line(line, prior_line)
-            if line:
-                line, in_comment = self._strip_comments(line, in_comment)
-                self._preprocess_line(line)
+        try:
+            for lineno, line in enumerate(file, 1):
+                if prior_line is None and not in_comment and (self._content_enabled != IF_STATE_NOW or not expand_source):
+                    # Inside an inactive #if block only directives matter, as they do everywhere if source is not expanded.
+                    # Lines which may open a comment or continue onto a directive still need full processing.
+                    if not line.lstrip().startswith("#") and "/*" not in line and not line.endswith("\\\n"):
+                        if self._content_enabled != IF_STATE_NOW:
+                            self.skipped_lines += 1
+                            continue
+                        if guard is None or guard.state == _IncludeGuard.OPEN or guard.state == _IncludeGuard.NONE:
+                            # include guard detection still needs to see content outside of the guard
+                            continue
+
+                # do the actual parsing
+                if prior_line is None:
+                    line_start = lineno
+                line, prior_line = self._join_escaped_line(line, prior_line)
+                if line:
+                    if not self._source_prior:
+                        # macro arguments continued over several lines are attributed to the line the call starts on
+                        origin = line_start
+                    line, in_comment = self._strip_comments(line, in_comment)
+                    if guard and guard.state != _IncludeGuard.NONE:
+                        stripped = line.strip()
+                        if stripped:
+                            guard.check_line(stripped, len(self._enable_stack))
+                        line = self._preprocess_line(line)
+                        guard.check_depth(len(self._enable_stack))
+                    else:
+                        line = self._preprocess_line(line)
+                    if line:
+                        if tracking:
+                            marker = self._mark_line(path, origin, line)
+                            if marker:
+                                yield marker
+                        yield line
+                    if self._include_request:
+                        # Nested includes are processed here, so that their lines are yielded in turn
+                        name, may_ignore = self._include_request
+                        self._include_request = None
+                        yield from self._iter_include(name, may_ignore = may_ignore)
                     
-        if len(self._enable_stack) != stack_depth:
-            raise Exception("unterminated #if found")
-        if in_comment:
-            raise Exception("unterminated comment found")
-        if self._source_prior:
-            self._source_prior = None
-            raise Exception("unterminated macro expression")
+            if len(self._enable_stack) != stack_depth:
+                raise Exception("unterminated #if found")
+            if in_comment:
+                raise Exception("unterminated comment found")
+            if self._source_prior:
+                self._source_prior = None
+                raise Exception("unterminated macro expression")
+
+            if guard:
+                token = guard.result()
+                if token:
+                    self._add_include_guard(path, token)
+        finally:
+            # Also restored if the lines are not consumed to the end, such as when iter_source() is abandoned
+            if len(self._enable_stack) > stack_depth:
+                self._content_enabled = self._enable_stack[stack_depth]
+                del self._enable_stack[stack_depth:]
+            self._current_path = prior_path
+            self._restore_local_path(prior_local)
+
+    def _tracking_lines(self):
+        return self.line_markers or self.source_map is not None
+
+    # Records the origin of an output line, returning the linemarker or blank lines that must precede it, if any
+    def _mark_line(self, path, line, text):
+        marker = None
+        if self.line_markers and (path != self._marker_path or line != self._marker_line):
+            gap = line - self._marker_line
+            if path == self._marker_path and 0 < gap <= MAX_LINE_MARKER_GAP:
+                marker = "\n" * gap
+                line_from = self._marker_line
+            else:
+                marker = "# {} \"{}\"\n".format(line, path.replace("\\", "\\\\").replace("\"", "\\\""))
+                line_from = line
+            if self.source_map is not None:
+                self.source_map.add(path, line_from, marker)
+        if self.source_map is not None:
+            self.source_map.add(path, line, text)
+        self._marker_path = path
+        self._marker_line = line + text.count("\n")
+        return marker
+
+    # returns true if a file does not need to be included again, due to an include guard or #pragma once
+    def _include_skippable(self, path):
+        if self.include_cache is not None and isinstance(self.macros, _MacroTable):
+            for frame in self.macros.frames:
+                if path not in frame.once_added and path not in frame.once_consulted:
+                    frame.once_consulted[path] = path in self._include_once
+        if path in self._include_once:
+            return True
+        token = self._include_guards.get(path)
+        return token is not None and self.is_defined(token)
+
+    def _add_include_guard(self, path, token):
+        self._include_guards[path] = token
+        if isinstance(self.macros, _MacroTable):
+            for frame in self.macros.frames:
+                frame.guards.append([path, token])
+
+    # Captures the macros, conditional state, include guards and settings, so they can be restored later.
+    # Should be taken between includes. Custom directives are not captured.
+    def snapshot(self):
+        self._macros_shared = True
+        self._source_shared = True
+        return PreprocessorState(self)
+
+    # Returns this preprocessor to the given state
+    def restore(self, state):
+        self.macros = state.macros
+        self.source_lines = state.source_lines
+        self._macros_shared = True
+        self._source_shared = True
+        # the state may hold deferred lines
+        self._deferred_lines = True
+        self._content_enabled = state.content_enabled
+        self._enable_stack = list(state.enable_stack)
+        self._local_path = state.local_path
+        self._include_guards = dict(state.include_guards)
+        self._include_once = set(state.include_once)
+        self.include_rule = state.include_rule
+        self.include_paths = list(state.include_paths)
+        self.ignore_missing_includes = state.ignore_missing_includes
+        self.max_macro_expansion_depth = state.max_macro_expansion_depth
+        self.include_cache = state.include_cache
+        self.expansion_engine = state.expansion_engine
+        self.encoding = state.encoding
+        self.encoding_errors = state.encoding_errors
+        self.use_mmap = state.use_mmap
+        self.index_directories = state.index_directories
+        self.file_provider = state.file_provider
+        self.expand_source = state.expand_source
+        self.line_markers = state.line_markers
+        self._marker_path = state.marker_path
+        self._marker_line = state.marker_line
+        self.lazy_expansion = state.lazy_expansion
+        self._generation = next(_GENERATIONS)
+
+    # Creates a new preprocessor starting from the current state of this one.
+    # A state may be passed to fork from an earlier snapshot instead.
+    def fork(self, state = None):
+        if state is None:
+            state = self.snapshot()
+        p = Preprocessor()
+        p.restore(state)
+        return p
+
+    # Starts recording the time spent in each phase, file and macro, and returns the Profile they are recorded in.
+    # Phases are timed by replacing methods on this instance, so there is no cost while profiling is disabled.
+    def enable_profiling(self):
+        if self.profile is None:
+            self.profile = Profile()
+            for name, phase in PROFILE_PHASES:
+                self._profile_method(name, phase)
+            self._profile_files()
+        return self.profile
+
+    # Stops profiling, and returns the recorded Profile
+    def disable_profiling(self):
+        profile = self.profile
+        if profile is not None:
+            for name, phase in PROFILE_PHASES:
+                del self.__dict__[name]
+            del self.__dict__["_iter_file"]
+            self.profile = None
+        return profile
+
+    def _profile_method(self, name, phase):
+        method = getattr(self, name)
+        counter = self.profile.phases.setdefault(phase, ProfileCounter())
+        def profiled(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                counter.add(time.perf_counter() - start)
+        setattr(self, name, profiled)
+
+    # Files are generators, so only the time spent producing each line is counted.
+    # Time spent in nested includes is subtracted from the file that includes them.
+    def _profile_files(self):
+        iter_file = self._iter_file
+        phase = self.profile.phases.setdefault("include", ProfileCounter())
+        files = self.profile.files
+        running = []
+        def profiled(file, path, *args):
+            counter = files.get(path)
+            if counter is None:
+                counter = files[path] = ProfileCounter()
+            lines = iter_file(file, path, *args)
+            # total and nested seconds
+            seconds = [0.0, 0.0]
+            value = None
+            try:
+                while True:
+                    running.append(seconds)
+                    start = time.perf_counter()
+                    try:
+                        # values are forwarded for include_async()
+                        line = lines.send(value)
+                    finally:
+                        elapsed = time.perf_counter() - start
+                        running.pop()
+                        seconds[0] += elapsed
+                        if running:
+                            running[-1][1] += elapsed
+                    value = yield line
+            except StopIteration:
+                pass
+            finally:
+                lines.close()
+                counter.add(seconds[0] - seconds[1])
+                phase.add(seconds[0] - seconds[1])
+        self._iter_file = profiled
+
+    # Discards the cached locations of included files.
+    # Required if files are added or removed between includes.
+    def clear_path_cache(self):
+        self._path_cache = {}
+        self._path_cache_paths = list(self.include_paths)
+        self._path_cache_provider = self.file_provider
+        self._directory_index = {}
+
+    # Finds the files included by a source file, without expanding its source lines.
+    # Conditional directives and the include_rule are honored, and macros are defined as they would be by include().
+    # Returns a dict mapping each file to the files it directly includes, starting with the source file.
+    def dependencies(self, path, file = None):
+        prior_expand = self.expand_source
+        prior_dependencies = self._dependencies
+        self.expand_source = False
+        self._dependencies = {} if file is None else { path: [] }
+        try:
+            for line in self._iter_include(path, file):
+                pass
+            return self._dependencies
+        finally:
+            self.expand_source = prior_expand
+            self._dependencies = prior_dependencies
+
+    # Returns the dependencies of a source file as a Makefile rule, in the style of gcc -M.
+    # The target defaults to the object file for the source.
+    def dependency_rule(self, path, target = None):
+        graph = self.dependencies(path)
+        if target is None:
+            target = os.path.splitext(os.path.basename(path))[0] + ".o"
+        names = [ name.replace(" ", "\\ ") for name in graph ]
+        return " \\\n  ".join([target.replace(" ", "\\ ") + ":"] + names) + "\n"
+
+    def _add_dependency(self, parent, path):
+        if path not in self._dependencies:
+            self._dependencies[path] = []
+        included = self._dependencies.get(parent)
+        if included is not None and path not in included:
+            included.append(path)
+
+    # Copies the macro table if it is shared with a snapshot
+    def _unshare_macros(self):
+        if self._macros_shared:
+            self.macros = type(self.macros)(self.macros)
+            self._macros_shared = False
+            self._deferred_pending = []
+        elif self._deferred_pending:
+            self._settle_deferred_lines()
+
+    def _add_include_once(self, path):
+        self._include_once.add(path)
+        if isinstance(self.macros, _MacroTable):
+            for frame in self.macros.frames:
+                frame.once_added.append(path)
 
-        self._restore_local_path(prior_local)
+    #
+    #     INCLUDE CACHING
+    #
+
+    # Includes a file from disk, replaying a cached result when the current macro state is compatible
+    def _iter_cached(self, path):
+        digest = self._file_digest(path)
+
+        # the result also depends on how nested includes are resolved
+        key = hashlib.sha1(json.dumps([
+            INCLUDE_CACHE_VERSION, digest, path, self.include_paths,
+            self.ignore_missing_includes, self.expansion_engine, self.encoding, self.encoding_errors,
+        ]).encode()).hexdigest()
+
+        if self._macros_shared or not isinstance(self.macros, _MacroTable):
+            # include frames must not be attached to a table shared with a snapshot
+            self.macros = _MacroTable(self.macros)
+            self._macros_shared = False
+
+        entry = self.include_cache.lookup(key, self._include_entry_valid)
+        if entry is not None:
+            yield from self._replay_include(entry)
+            return
+
+        with open(path, "rb") as file:
+            data = file.read()
+
+        frame = _IncludeFrame()
+        # a partially expanded source line would be glued into this file
+        frame.cacheable = self._source_prior is None and self._flow_enabled()
+        if hashlib.sha1(data).hexdigest() != digest:
+            # the file changed since it was hashed
+            frame.cacheable = False
+
+        self.macros.frames.append(frame)
+        try:
+            for line in self._iter_file(io.TextIOWrapper(io.BytesIO(data), self.encoding, self.encoding_errors), path, True):
+                # the source must be kept for the cache entry
+                frame.source.append(line)
+                yield line
+        finally:
+            self.macros.frames.remove(frame)
+
+        if frame.cacheable:
+            self.include_cache.store(key, {
+                "consulted": [ [token, self._serialize_macro(macro)] for token, macro in frame.consulted.items() ],
+                "written": [ [token, self._serialize_macro(macro)] for token, macro in frame.written.items() ],
+                "includes": frame.includes,
+                "guards": frame.guards,
+                "once_consulted": list(frame.once_consulted.items()),
+                "once": frame.once_added,
+                "source": frame.source,
+            })
+
+    # Checks that a cache entry was recorded with the current macros and include files
+    def _include_entry_valid(self, entry):
+        for token, state in entry["consulted"]:
+            if self._serialize_macro(self.macros.get(token)) != state:
+                return False
+        for path, included in entry["once_consulted"]:
+            if (path in self._include_once) != included:
+                return False
+        for name, local_path, allowed, path, digest in entry["includes"]:
+            if bool(self.include_rule(name)) != allowed:
+                return False
+            if allowed:
+                prior_local = self._local_path
+                self._local_path = local_path
+                resolved = self._resolve_path(name)
+                self._local_path = prior_local
+                if resolved != path or self._file_digest(path) != digest:
+                    return False
+        return True
+
+    # Applies the recorded effects of a cache entry, and returns the recorded source lines
+    def _replay_include(self, entry):
+        for record in entry["includes"]:
+            for frame in self.macros.frames:
+                frame.includes.append(record)
+            if self._dependencies is not None and record[2] and record[4] is not None:
+                # the file that made the include is not recorded
+                self._add_dependency(None, record[3])
+        for token, state in entry["written"]:
+            if state is None:
+                self.undefine(token)
+            else:
+                self.define(token, state[0], state[1])
+        for path, token in entry["guards"]:
+            self._add_include_guard(path, token)
+        for path in entry["once"]:
+            self._add_include_once(path)
+        return entry["source"]
+
+    # Records an include for all active cache frames
+    def _record_include(self, name, allowed, path = None):
+        if self.macros.frames:
+            record = [name, self._local_path, bool(allowed), path, self._file_digest(path) if allowed else None]
+            for frame in self.macros.frames:
+                frame.includes.append(record)
+
+    # Marks the files currently being included as uncacheable
+    def _disable_include_caching(self):
+        if isinstance(self.macros, _MacroTable):
+            for frame in self.macros.frames:
+                frame.cacheable = False
+
+    # returns the content hash of a file, or None if it does not exist
+    def _file_digest(self, path):
+        stamp = self._file_stamp(path)
+        if stamp is None:
+            return None
+        known = self._digests.get(path)
+        if known and known[0] == stamp:
+            return known[1]
+        with open(path, "rb") as file:
+            digest = hashlib.sha1(file.read()).hexdigest()
+        self._digests[path] = (stamp, digest)
+        return digest
+
+    def _file_stamp(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def _serialize_macro(macro):
+        if macro is None:
+            return None
+        return [macro.expr, list(macro.args) if macro.args is not None else None]
 
     # Lines ending with '\' need to be joined.
     def _join_escaped_line(self, line, prior):
@@ -206,59 +1975,152 @@ class Preprocessor():
         else:
             return line, None
 
-    # Removes any comments.
+    # Removes any comments, in a single pass over the line.
     # /**/ comment block state is handled over multiple lines with in_comment variable.
+    # Each comment ending within the line is replaced by a space, as it still separates the tokens around it.
+    # String and character literals are skipped, so they may contain // or /*. If a comment runs to the end of
+    # the line, the line break is kept after any source before it.
     def _strip_comments(self, line, in_comment):
-        # first, everything after // is lost
-        if "//" in line:
-            line = line.split("//", 1)[0]
-
         if in_comment:
-            line, comment = "", line
+            pos = line.find("*/")
+            if pos < 0:
+                return "", True
+            pos += 2
+            in_comment = False
+            if line.find("/", pos) < 0:
+                return line[pos:], False
+        elif "/" not in line:
+            # most lines contain no comments at all
+            return line, False
+        else:
+            pos = 0
 
+        # literals only need to be skipped if the line contains any
+        quoted = '"' in line or "'" in line
+        text = ""
         while True:
-            # Toggle between checking for start and end of comments until no more are found.
-            if in_comment:
-                if "*/" in comment:
-                    # add the components after the comment ends
-                    line += comment.split("*/", 1)[1]
-                    in_comment = False
-                else:
-                    break
-            else: # not in comment
-                if "/*" in line:
-                    # grab everything before the comment starts
-                    line, comment = line.split("/*", 1)
-                    in_comment = True
-                else:
-                    break
+            # the delimiters are searched for directly, as the literals before them are rare
+            block = line.find("/*", pos)
+            comment = line.find("//", pos)
+            start = comment if comment >= 0 and (block < 0 or comment < block) else block
+            if start < 0:
+                return text + line[pos:], False
+            if quoted:
+                dquote = line.find('"', pos, start)
+                squote = line.find("'", pos, start)
+                quote = dquote if squote < 0 or 0 <= dquote < squote else squote
+                if quote >= 0:
+                    # literals are copied over whole
+                    end = LITERAL_REGEX.match(line, quote).end()
+                    text += line[pos:end]
+                    pos = end
+                    continue
+
+            text += line[pos:start]
+            if start == comment:
+                break
+            pos = line.find("*/", start + 2)
+            if pos < 0:
+                in_comment = True
+                break
+            text += " "
+            pos += 2
 
-        return line, in_comment
+        # the comment runs to the end of the line
+        if text and line.endswith("\n"):
+            text += "\n"
+        return text, in_comment
 
     # Checks for preprocessor directives and invokes them.
     # Returns true if the line was consumed.
     def _preprocess_directives(self, line, enabled):
         line = line.strip()
         if line.startswith("#"):
-            for directive in self._directives:
+            # Only the directives registered for the keyword need to be tried
+            match = DIRECTIVE_KEYWORD_REGEX.match(line)
+            if match:
+                directives = self._directive_table.get(match.group(1))
+                if directives:
+                    for directive in directives:
+                        if directive.invoke(line, enabled):
+                            return True
+            for directive in self._generic_directives:
                 if directive.invoke(line, enabled):
                     return True
         return False
 
     # Runs a line through the preprocessor
+    # Returns the expanded line if it is source
     def _preprocess_line(self, line):
         # check for directives
         enabled = self._flow_enabled()
         if not self._preprocess_directives(line, enabled):
             # if not a directive, then the line is source
-            if enabled:
+            if enabled and self.expand_source:
                 if self._source_prior:
                     # glue the prior line to the new line
                     line = self._source_prior + line
                     self._source_prior = None
+                elif self.lazy_expansion and self._can_defer(line):
+                    return self._defer_line(line)
                 line, self._source_prior = self._expand_macros(line)
-                if line:
-                    self.source_lines.append(line)
+                return line
+        return None
+
+    # Lines which may leave a macro call unterminated are expanded immediately, so they can be joined to the next line
+    def _can_defer(self, line):
+        if self.include_cache is not None or self._streaming or self._tracking_lines():
+            return False
+        if TRAILING_TOKEN_REGEX.search(line):
+            return False
+        if "(" not in line and ")" not in line:
+            return True
+        # The line must not close a call begun on an earlier line, nor leave one open
+        depth = 0
+        for match in PAREN_SCAN_REGEX.finditer(line):
+            paren = match.group()
+            if paren == "(":
+                depth += 1
+            elif paren == ")":
+                depth -= 1
+                if depth < 0:
+                    return False
+        return depth == 0
+
+    def _defer_line(self, line):
+        line = _DeferredLine(line, self.macros, self._generation)
+        self._deferred_pending.append(line)
+        self._deferred_lines = True
+        return line
+
+    # Called before the macro table is modified, as the pending deferred lines must keep the table as it is now.
+    # The table is copied if enough lines share it, otherwise copying would cost more than expanding them immediately.
+    def _settle_deferred_lines(self):
+        pending = self._deferred_pending
+        if len(pending) * DEFERRED_COPY_RATIO >= len(self.macros):
+            self.macros = type(self.macros)(self.macros)
+        else:
+            for line in pending:
+                self._expand_deferred_line(line)
+        self._deferred_pending = []
+
+    # Expands a deferred line with the macros defined when it was read.
+    # The line keeps the expanded text, so it is only expanded once.
+    def _expand_deferred_line(self, line):
+        if line.macros is None:
+            # already expanded
+            return line.text
+        macros, generation = self.macros, self._generation
+        self.macros, self._generation = line.macros, line.generation
+        try:
+            text, remainder = self._expand_macros(line.text)
+        finally:
+            self.macros, self._generation = macros, generation
+        if remainder:
+            raise Exception("unterminated macro expression")
+        line.text = text
+        line.macros = None
+        return text
 
     #
     #     PATH RESOLUTION
@@ -266,18 +2128,53 @@ class Preprocessor():
 
     # Resolves an include path to the current working directory.
     def _resolve_path(self, path):
+        return self._find_path(path)[0]
+
+    # Returns the resolved path, and whether it exists.
+    # Results are cached for each local path, including files that could not be found.
+    # The local path defaults to that of the file being processed.
+    def _find_path(self, path, local_path = None):
+        if self.include_paths != self._path_cache_paths or self.file_provider is not self._path_cache_provider:
+            self.clear_path_cache()
+        if local_path is None:
+            local_path = self._local_path
+        key = (local_path, path)
+        found = self._path_cache.get(key)
+        if found is None:
+            found = self._path_cache[key] = self._search_path(path, local_path)
+        return found
+
+    def _search_path(self, path, local_path):
         # try local path first
-        candiate = os.path.normpath(os.path.join(self._local_path, path))
-        if os.path.exists(candiate):
-            return candiate
+        candiate = os.path.normpath(os.path.join(local_path, path))
+        if self._path_exists(candiate):
+            return candiate, True
 
         # test all include paths
         for dir in self.include_paths:
             candiate = os.path.normpath(os.path.join(dir, path))
-            if os.path.exists(candiate):
-                return candiate
+            if self._path_exists(candiate):
+                return candiate, True
         
-        return path # just return the path as a last resort.
+        return path, self._path_exists(path) # just return the path as a last resort.
+
+    def _path_exists(self, path):
+        provider = self.file_provider
+        if not self.index_directories or (provider is not None and not hasattr(provider, "listdir")):
+            return os.path.exists(path) if provider is None else provider.exists(path)
+        # look the file up in a listing of its directory, so each directory is only read once
+        directory, name = os.path.split(path)
+        names = self._directory_index.get(directory)
+        if names is None:
+            try:
+                if provider is None:
+                    names = set(os.listdir(directory if directory else "."))
+                else:
+                    names = set(provider.listdir(directory if directory else "."))
+            except OSError:
+                names = set()
+            self._directory_index[directory] = names
+        return name in names
 
     # Sets the current local path to the directory of the current processed file
     # Returns the previous path so that it may be restored
@@ -303,7 +2200,7 @@ class Preprocessor():
 
     # Rule to handle: #define <token>(<any>) [<expression>]
     def _directive_define_varidic(self, args):
-        varargs = [ a.strip() for a in args[1].split(",") ]
+        varargs = [ a.strip() for a in args[1].split(",") ] if args[1].strip() else []
         self.define(args[0], args[2], varargs)
 
     # Rule to handle: #if <expression>
@@ -334,7 +2231,10 @@ class Preprocessor():
     def _directive_include(self, args):
         fname = args[0]
         if self.include_rule(fname):
-            self.include(fname, may_ignore=self.ignore_missing_includes)
+            # The include is made once the current line is complete
+            self._include_request = (fname, self.ignore_missing_includes)
+        elif self.include_cache is not None and isinstance(self.macros, _MacroTable):
+            self._record_include(fname, False)
 
     # Rule to handle: #error <any>
     def _directive_error(self, args):
@@ -347,11 +2247,19 @@ class Preprocessor():
     # Rule to handle: #pragma <any>
     def _directive_pragma(self, args):
 
+        # the current file should not be included again
+        if args[0].strip() == "once":
+            if self._current_path is not None:
+                self._add_include_once(self._current_path)
+            return
+
         # custom pragma to execute python within the source. Useful for debugging.
         # #pragma python "print(p.macros)"
         # The current preprocessor instance is passed as the only local: p
         match = re.match(r"python\s+\"([^\"]*)\"", args[0])
         if match:
+            # the effects of arbitrary python cannot be cached
+            self._disable_include_caching()
             expr = match.groups()[0]
             eval(expr, None, { "p": self })
     
@@ -448,10 +2356,37 @@ class Preprocessor():
 
     # Expands all macros in the given expression
     def expand(self, expr):
-        expr, remainder = self._expand_macros(expr)
+        return self._expand_expression(expr)
+
+    # Expands a complete expression, memoizing the result until the macros change
+    def _expand_expression(self, expr, evaluate = False):
+        memoize = self._memoize_enabled()
+        if memoize:
+            if self._expansion_cache_generation != self._generation:
+                self._expansion_cache.clear()
+                self._expansion_cache_generation = self._generation
+            key = (expr, evaluate)
+            result = self._expansion_cache.get(key)
+            if result is not None:
+                self._expansion_cache.move_to_end(key)
+                self.expansion_cache_hits += 1
+                return result
+            self.expansion_cache_misses += 1
+
+        result, remainder = self._expand_macros(expr, evaluate)
         if remainder:
             raise Exception("Unterminated macro in expression")
-        return expr
+
+        if memoize:
+            self._expansion_cache[key] = result
+            if len(self._expansion_cache) > self.max_expansion_cache_size:
+                self._expansion_cache.popitem(last = False)
+        return result
+
+    # Memoized expansions, and shortcuts which check the whole macro table at once, skip macro lookups.
+    # They cannot be used while include cache frames record them.
+    def _memoize_enabled(self):
+        return not (type(self.macros) is _MacroTable and self.macros.frames)
     
     def _is_empty_token(self, token):
         # If _split_args could return stripped arguments (ie, it was aware of whether it was parsing varargs or not)
@@ -460,7 +2395,250 @@ class Preprocessor():
     
     # Expands all macros in the given expression
     # May return a remainder string if the expression is not fully expanded
-    def _expand_macros(self, expr):
+    # If evaluate is set, defined(<token>) operators are resolved during expansion
+    def _expand_macros(self, expr, evaluate = False):
+        if self.expansion_engine == EXPANSION_ENGINE_STRING:
+            if evaluate:
+                self._unshare_macros()
+                self.macros["defined"] = self._defined_macro
+                try:
+                    return self._expand_macros_string(expr)
+                finally:
+                    del self.macros["defined"]
+            return self._expand_macros_string(expr)
+        return self._expand_macros_token(expr, evaluate)
+
+    # Expands all macros by rescanning a stack of lexed tokens.
+    # Expansions are pushed back onto the stack, so each substitution only costs the length of the expansion.
+    def _expand_macros_token(self, expr, evaluate = False):
+        tokens = LEX_TOKEN_REGEX.findall(expr)
+        if self._memoize_enabled() and self.macros.keys().isdisjoint(tokens) and not (evaluate and "defined" in tokens):
+            # most source lines reference no macros at all
+            return expr, None
+        tokens, remainder = self._expand_tokens(tokens, evaluate, expr)
+        if remainder is not None:
+            return None, remainder
+        return "".join(tokens), None
+
+    # Expands a list of tokens, returning the expanded tokens.
+    # If the expression is unterminated, the remainder is returned as a string instead.
+    # A macro is not expanded again while the tokens of its own expansion are being rescanned.
+    # disabled maps these macros to the stack length below which their expansion ends.
+    def _expand_tokens(self, tokens, evaluate = False, expr = None, disabled = None):
+        macros = self.macros
+        memoize = self._memoize_enabled()
+        profile = self.profile
+        output = []
+        stack = tokens[::-1]
+        expansion_depth = 0
+        if disabled is None:
+            disabled = {}
+        active = list(disabled)
+        # the stack length at which the innermost expansion ends
+        boundary = disabled[active[-1]] if active else -1
+
+        while stack:
+            token = stack.pop()
+            macro = macros.get(token)
+            if macro is None:
+                if evaluate and token == "defined":
+                    token = self._take_defined_operand(stack)
+                output.append(token)
+                continue
+
+            if len(stack) < boundary:
+                # the expansions which ended before this token may be expanded again
+                while active and len(stack) < disabled[active[-1]]:
+                    del disabled[active.pop()]
+                boundary = disabled[active[-1]] if active else -1
+
+            if token in disabled or type(token) is _PaintedToken:
+                # A macro found within its own expansion is never expanded
+                output.append(_PaintedToken(token))
+                continue
+
+            # check we arent caught in a loop
+            if expansion_depth > self.max_macro_expansion_depth:
+                raise Exception(f"Max macro expansion depth exceeded (in expression \"{expr.strip()}\")")
+
+            if profile is not None:
+                started = time.perf_counter()
+
+            if macro.args != None:
+                # find the arguments
+                args, end = self._find_token_arguments(stack)
+                if args == None:
+                    # Function-like macros are not expanded without arguments
+                    output.append(token)
+                    continue
+                if end == None:
+                    # We have an unterminated argument list.
+                    # this line will have to be glued to the next line, and expanded again as a whole.
+                    return None, expr
+                # arguments without any macros need neither painting nor expanding
+                plain = memoize and all(macros.keys().isdisjoint(arg) for arg in args)
+                if not plain and disabled and self._paint_arguments(stack, end, args, disabled):
+                    args, end = self._find_token_arguments(stack)
+                del stack[end:]
+
+                # expansions which ended within the arguments are complete
+                while active and len(stack) < disabled[active[-1]]:
+                    del disabled[active.pop()]
+                boundary = disabled[active[-1]] if active else -1
+
+                # Handle the case where macro is called with an empty argument list
+                if len(args) == 1 and len(macro.args) == 0 and all(t.isspace() for t in args[0]):
+                    args = []
+
+                if len(args) != len(macro.args) and not macro.is_variadic():
+                    raise Exception("Macro \"{0}\" requires {1} arguments (in expression \"{2}\")".format(token, len(macro.args), expr.strip()))
+
+                if plain:
+                    expansion = macro.expand_tokens(args)
+                else:
+                    expansion = macro.expand_tokens(args, lambda arg: self._expand_argument(arg, evaluate, expr, disabled))
+            else:
+                if memoize:
+                    expanded = self._expanded_body(macro)
+                    if expanded is not None:
+                        # A fully expanded body does not need to be rescanned
+                        output.extend(expanded)
+                        expansion_depth += 1
+                        if profile is not None:
+                            profile.add_macro(token, time.perf_counter() - started)
+                        continue
+                expansion = macro.expand_tokens()
+
+            if memoize and macros.keys().isdisjoint(expansion) and not (evaluate and "defined" in expansion):
+                # Nothing in the expansion can be expanded, including substituted arguments, which were already expanded.
+                # The rescan, and the bookkeeping to prevent recursion, can be skipped.
+                output.extend(expansion)
+                expansion_depth += 1
+                if profile is not None:
+                    profile.add_macro(token, time.perf_counter() - started)
+                continue
+
+            # push the expansion back on the stack, so it gets rescanned along with the rest of the expression
+            disabled[token] = boundary = len(stack)
+            active.append(token)
+            stack.extend(reversed(expansion))
+            expansion_depth += 1
+            if profile is not None:
+                profile.add_macro(token, time.perf_counter() - started)
+
+        self.macro_expansions += expansion_depth
+        return output, None
+
+    # Paints the tokens of function-like macro arguments that were read from within their own expansion.
+    # Returns true if any tokens were painted.
+    def _paint_arguments(self, stack, end, args, disabled):
+        keys = disabled.keys()
+        if all(keys.isdisjoint(arg) for arg in args):
+            return False
+        painted = False
+        for i in range(end, len(stack)):
+            token = stack[i]
+            if token in disabled and disabled[token] <= i and type(token) is not _PaintedToken:
+                stack[i] = _PaintedToken(token)
+                painted = True
+        return painted
+
+    # Fully expands a macro argument before it is substituted.
+    # Macros being expanded where the arguments were found are not expanded again.
+    def _expand_argument(self, tokens, evaluate, expr, disabled):
+        if self._memoize_enabled() and self.macros.keys().isdisjoint(tokens):
+            return tokens
+        expanded, remainder = self._expand_tokens(tokens, evaluate, expr, dict.fromkeys(disabled, 0))
+        return tokens if remainder is not None else expanded
+
+    # returns the fully expanded body of an object-like macro, cached for the current macro table generation.
+    # Returns None if the body can not be expanded independently of the tokens that follow it.
+    def _expanded_body(self, macro):
+        if macro._expanded_generation == self._generation:
+            return macro._expanded
+        macro._expanded_generation = self._generation
+        macro._expanded = None
+
+        tokens = macro.expand_tokens()
+        if self.macros.keys().isdisjoint(tokens):
+            if "defined" not in tokens:
+                macro._expanded = tokens
+        # limit the recursion through chains of constants
+        elif self._body_expansion_depth < 32:
+            self._body_expansion_depth += 1
+            try:
+                expanded, remainder = self._expand_tokens(tokens, False, macro.expr, { macro.token: 0 })
+            except Exception:
+                # let the error be raised by the regular expansion
+                expanded = None
+            finally:
+                self._body_expansion_depth -= 1
+
+            # any remaining macro (such as a function-like macro) may take arguments from the following tokens
+            if expanded is not None and "defined" not in expanded and self.macros.keys().isdisjoint(expanded):
+                if len(expanded) > MAX_EXPANDED_BODY_TOKENS:
+                    # used this once, but later references are rescanned
+                    return expanded
+                macro._expanded = expanded
+        return macro._expanded
+
+    # Finds the arguments for a function-like macro at the top of a token stack.
+    # Returns the arguments as token lists, and the stack index of the closing parenthesis.
+    # The arguments are None if there is no argument list, and the index is None if it is unterminated.
+    def _find_token_arguments(self, stack):
+        i = len(stack) - 1
+        while i >= 0 and stack[i].isspace():
+            i -= 1
+        if i < 0 or stack[i] != "(":
+            return None, None
+
+        # arguments are sliced from the stack, so only delimiters need to be inspected
+        args = []
+        depth = 0
+        start = i
+        for i in range(i - 1, -1, -1):
+            token = stack[i]
+            if token in ARGUMENT_DELIMITERS:
+                if token == ")":
+                    if depth == 0:
+                        args.append(stack[start - 1:i:-1])
+                        return args, i
+                    depth -= 1
+                elif token == "(":
+                    depth += 1
+                elif depth == 0:
+                    args.append(stack[start - 1:i:-1])
+                    start = i
+        return args, None
+
+    # Resolves the operand of a defined operator at the top of a token stack.
+    # Both the defined(<token>) and defined <token> forms are accepted.
+    def _take_defined_operand(self, stack):
+        i = len(stack) - 1
+        while i >= 0 and stack[i].isspace():
+            i -= 1
+        parenthesized = i >= 0 and stack[i] == "("
+        if parenthesized:
+            i -= 1
+            while i >= 0 and stack[i].isspace():
+                i -= 1
+        if i < 0:
+            return "defined"
+        token = stack[i]
+        i -= 1
+        if parenthesized:
+            while i >= 0 and stack[i].isspace():
+                i -= 1
+            if i < 0 or stack[i] != ")":
+                return "defined"
+            i -= 1
+        del stack[i+1:]
+        return "1" if self.is_defined(token) else "0"
+
+    # Expands all macros by splicing expansions back into the expression string
+    # May return a remainder string if the expression is not fully expanded
+    def _expand_macros_string(self, expr):
+        profile = self.profile
         expansion_depth = 0
         # expand macros
         start = 0
@@ -479,6 +2657,9 @@ class Preprocessor():
                 if expansion_depth > self.max_macro_expansion_depth:
                     raise Exception(f"Max macro expansion depth exceeded (in expression \"{expr.strip()}\")")
 
+                if profile is not None:
+                    started = time.perf_counter()
+
                 # expand the macro
                 macro = self.macros[token]
                 if macro.args != None:
@@ -498,7 +2679,7 @@ class Preprocessor():
                         if len(args) == 1 and len(macro.args) == 0 and self._is_empty_token(args[0]):
                             args = []
 
-                        if len(args) != len(macro.args) and not any([re.search(VA_ARG_REGEX, macro.args[i]) for i in range(len(macro.args))]):
+                        if len(args) != len(macro.args) and not macro.is_variadic():
                             raise Exception("Macro \"{0}\" requires {1} arguments (in expression \"{2}\")".format(token, len(macro.args), expr.strip()))
                         
                         # replace the macro with the expanded expression
@@ -513,10 +2694,13 @@ class Preprocessor():
                 expr = expr[:start] + macro_expr + expr[end:]
                 # do not increase the start point - we should recheck this for new tokens to be expanded.
                 expansion_depth += 1
+                if profile is not None:
+                    profile.add_macro(token, time.perf_counter() - started)
             else:
                 # proceed over the token
                 start = end
 
+        self.macro_expansions += expansion_depth
         return expr, None
 
     #
@@ -525,24 +2709,28 @@ class Preprocessor():
 
     # Evaluates an expression
     def evaluate(self, expr):
-
-        self.macros["defined"] = self._defined_macro
-        expr = self.expand(expr)
-        del self.macros["defined"]
-
-        # convert to python expression (this may be very dangerous)
-        expr = expr.replace("&&", " and ")
-        expr = expr.replace("||", " or ")
-        expr = expr.replace("/", "//")
-        expr = re.sub(r"!([^?==])", r" not \1", expr)
-        
-        result = eval(expr)
-        return result
+        return self._evaluate(expr)
+
+    # Evaluates an expression, with any identifiers left after expansion taking the undefined_value.
+    # If undefined_value is None, these identifiers are an error.
+    def _evaluate(self, expr, undefined_value = None):
+        expr = self._expand_expression(expr, True)
+
+        # The expanded text is constant, so its value can be cached along with the compiled expression
+        key = (expr, undefined_value)
+        value = self._expression_cache.get(key)
+        if value is None:
+            value = _ExpressionCompiler(expr, undefined_value).compile()()
+            if len(self._expression_cache) >= self.max_expression_cache_size:
+                self._expression_cache.clear()
+            self._expression_cache[key] = value
+        return value
 
     # Tests an expression for truth.
     def _test_expression(self, expr):
         try:
-            result = self.evaluate(expr)
+            # As in C, identifiers remaining after macro expansion are replaced with 0
+            result = self._evaluate(expr, 0)
             if type(result) is str:
                 return False
             return bool(result)
@@ -0,0 +1,353 @@
+import argparse
+import glob
+import json
+import os.path
+import re
+import sys
+import time
+import tracemalloc
+
+# Hack to include module in base directory
+sys.path.insert(0, os.path.abspath('./'))
+from preprocessor import Preprocessor, Directive
+
+SRC_PATH = "tests/test_src"
+
+# Runs a function repeatedly, and returns the best time for a single run
+def best_time(func, repeat = 5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, count, unit, elapsed):
+    print("{:<40} {:>12.0f} {}/s".format(name, count / elapsed, unit))
+
+# Collects the stripped lines of every file in the source tree
+def source_lines():
+    lines = []
+    for path in sorted(glob.glob(os.path.join(SRC_PATH, "**", "*.[ch]"), recursive = True)):
+        with open(path, "r") as file:
+            lines.extend(line.strip() for line in file.readlines())
+    return lines
+
+# Counts the lines read by a preprocessor, including those of nested includes
+def count_lines(p):
+    iter_file = p._iter_file
+    counter = [0]
+    def counting_iter_file(file, *args):
+        def lines():
+            for line in file:
+                counter[0] += 1
+                yield line
+        return iter_file(lines(), *args)
+    p._iter_file = counting_iter_file
+    return counter
+
+# Times a preprocessing run. run(p) must preprocess its input with the given preprocessor.
+# Lines, expansions and peak memory are measured in a separate untimed run, as tracing slows the run down.
+def measure(name, run, repeat = 5):
+    elapsed = best_time(lambda: run(Preprocessor()), repeat)
+
+    p = Preprocessor()
+    counter = count_lines(p)
+    tracemalloc.start()
+    run(p)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        "name": name,
+        "seconds": elapsed,
+        "lines": counter[0],
+        "lines_per_second": counter[0] / elapsed,
+        "expansions": p.macro_expansions,
+        "expansions_per_second": p.macro_expansions / elapsed,
+        "peak_memory": peak,
+    }
+    print("{:<40} {:>12.0f} lines/s {:>12.0f} expansions/s {:>10.0f} KiB".format(
+        name, result["lines_per_second"], result["expansions_per_second"], peak / 1024))
+    return result
+
+
+#
+#     USB SOURCE TREE
+#
+
+# Preprocesses every source file in the USB tree for a given class, as a firmware build would
+def usb_run(usb_class):
+    paths = sorted(glob.glob(os.path.join(SRC_PATH, "usb", "*.c")) + glob.glob(os.path.join(SRC_PATH, "usb", usb_class.lower(), "*.c")))
+    def run(p):
+        p.ignore_missing_includes = True
+        p.add_include_path(SRC_PATH)
+        p.define("USB_ENABLE")
+        p.define("USB_CLASS_" + usb_class)
+        for path in paths:
+            p.include(path)
+            p.source_lines = []
+    return run
+
+# Collects the macros of every source file in the USB tree, without expanding source
+def usb_macros_run(usb_class):
+    run_sources = usb_run(usb_class)
+    def run(p):
+        p.expand_source = False
+        run_sources(p)
+    return run
+
+# Parses every source file in the USB tree, deferring expansion of the source until it is read
+def usb_lazy_run(usb_class):
+    run_sources = usb_run(usb_class)
+    def run(p):
+        p.lazy_expansion = True
+        run_sources(p)
+    return run
+
+# Finds the dependencies of every source file in the USB tree, without expanding source
+def usb_dependencies_run(usb_class):
+    paths = sorted(glob.glob(os.path.join(SRC_PATH, "usb", "*.c")) + glob.glob(os.path.join(SRC_PATH, "usb", usb_class.lower(), "*.c")))
+    def run(p):
+        p.ignore_missing_includes = True
+        p.add_include_path(SRC_PATH)
+        p.define("USB_ENABLE")
+        p.define("USB_CLASS_" + usb_class)
+        for path in paths:
+            p.dependencies(path)
+    return run
+
+def benchmark_usb():
+    return [
+        measure("usb (CDC)", usb_run("CDC")),
+        measure("usb (MSC)", usb_run("MSC")),
+        measure("usb macros only (CDC)", usb_macros_run("CDC")),
+        measure("usb macros only (MSC)", usb_macros_run("MSC")),
+        measure("usb lazy expansion (CDC)", usb_lazy_run("CDC")),
+        measure("usb lazy expansion (MSC)", usb_lazy_run("MSC")),
+        measure("usb dependencies (CDC)", usb_dependencies_run("CDC")),
+        measure("usb dependencies (MSC)", usb_dependencies_run("MSC")),
+    ]
+
+
+#
+#     STRESS CASES
+#
+
+# Function-like macros, each expanding to the previous one
+def stress_deep_nesting(depth = 100, count = 50):
+    lines = [ "#define F0(x) (x)" ]
+    lines += [ "#define F{}(x) F{}((x) + {})".format(i, i - 1, i) for i in range(1, depth) ]
+    lines += [ "int a{} = F{}({});".format(i, depth - 1, i) for i in range(count) ]
+    return "\n".join(lines) + "\n"
+
+# Variadic macros called with many arguments
+def stress_wide_variadic(width = 200, count = 100):
+    lines = [ "#define CALL(f, ...) f(__VA_ARGS__)", "#define ARGS(...) { __VA_ARGS__ }" ]
+    args = ", ".join(str(i) for i in range(width))
+    lines += [ "int a{} = CALL(sum, ARGS({}));".format(i, args) for i in range(count) ]
+    return "\n".join(lines) + "\n"
+
+# Definitions continued over many lines
+def stress_continuation_lines(length = 500, count = 20):
+    lines = []
+    for i in range(count):
+        lines.append("#define TABLE{} \\".format(i))
+        lines += [ "    {}, \\".format(j) for j in range(length) ]
+        lines.append("    {}".format(length))
+        lines.append("int table{}[] = {{ TABLE{} }};".format(i, i))
+    return "\n".join(lines) + "\n"
+
+# A large number of definitions, each referenced once
+def stress_many_defines(count = 5000):
+    lines = [ "#define D{} ({} << SHIFT)".format(i, i) for i in range(count) ]
+    lines.append("#define SHIFT 2")
+    lines += [ "int a{} = D{};".format(i, i) for i in range(count) ]
+    return "\n".join(lines) + "\n"
+
+# Nested conditional blocks, with both active and inactive branches
+def stress_deep_conditionals(depth = 200, count = 20):
+    lines = [ "#define LEVEL {}".format(depth // 2) ]
+    for i in range(depth):
+        lines.append("#if LEVEL > {}".format(i))
+        lines += [ "int a{}_{};".format(i, j) for j in range(count) ]
+        lines.append("#else")
+        lines += [ "int b{}_{};".format(i, j) for j in range(count) ]
+    lines += [ "#endif" ] * depth
+    return "\n".join(lines) + "\n"
+
+def stress_run(source):
+    def run(p):
+        p.include("stress.h", source)
+    return run
+
+def benchmark_stress():
+    return [
+        measure("stress (deep nesting)", stress_run(stress_deep_nesting())),
+        measure("stress (wide variadic)", stress_run(stress_wide_variadic())),
+        measure("stress (continuation lines)", stress_run(stress_continuation_lines())),
+        measure("stress (many defines)", stress_run(stress_many_defines())),
+        measure("stress (deep conditionals)", stress_run(stress_deep_conditionals())),
+    ]
+
+
+# Measures the cost of a single invocation of function-like macros, in each expansion engine
+def benchmark_macro_calls(calls = 20000):
+    p = Preprocessor()
+    p.define("ADD", "((a) + (b) * (c))", ["a", "b", "c"])
+    p.define("LOG", "log(level, fmt, __VA_ARGS__)", ["level", "fmt", "..."])
+    add = p.macros["ADD"]
+    log = p.macros["LOG"]
+
+    add_args = [ ["x"], [" ", "y", "+", "1"], ["z"] ]
+    log_args = [ ["1"], ["\"%d %d\""], ["a"], [" ", "b"] ]
+    def tokens():
+        for i in range(calls):
+            add.expand_tokens(add_args)
+            log.expand_tokens(log_args)
+    report("macro calls (tokens)", calls * 2, "calls", best_time(tokens))
+
+    add_args = [ "x", " y + 1", "z" ]
+    log_args = [ "1", "\"%d %d\"", "a", " b" ]
+    def strings():
+        for i in range(calls):
+            add.expand(add_args)
+            log.expand(log_args)
+    report("macro calls (strings)", calls * 2, "calls", best_time(strings))
+
+    # Full expansions of an expression, bypassing the expansion cache
+    expr = "ADD(1, ADD(2, 3, 4), 5) + LOG(0, \"%d\", ADD(a, b, c))"
+    def expressions():
+        for i in range(calls // 10):
+            p._expand_macros(expr)
+    report("macro calls (expressions)", calls // 10 * 4, "calls", best_time(expressions))
+
+
+# Compares dispatching directives by keyword against trying every directive in turn
+def benchmark_directives(passes = 50):
+    lines = [ line for line in source_lines() if line.startswith("#") ] * passes
+
+    # Replace the directive actions, so only the dispatch is measured
+    p = Preprocessor()
+    directives = [ directive for table in p._directive_table.values() for directive in table ] + p._generic_directives
+    p._directive_table = {}
+    p._generic_directives = []
+    scanned = []
+    for directive in directives:
+        directive = Directive(directive.pattern.pattern, lambda args: None, directive.conditional)
+        p.add_directive(directive)
+        scanned.append(directive)
+
+    def linear_scan():
+        for line in lines:
+            for directive in scanned:
+                if directive.invoke(line, True):
+                    break
+
+    def dispatch():
+        for line in lines:
+            p._preprocess_directives(line, True)
+
+    report("directives (linear scan)", len(lines), "lines", best_time(linear_scan))
+    report("directives (keyword dispatch)", len(lines), "lines", best_time(dispatch))
+
+
+# Compares stripping comments in a single pass against the former approach of splitting the line repeatedly
+def benchmark_comments(passes = 200):
+    with open(os.path.join(SRC_PATH, "usb", "USB_Defs.h"), "r") as file:
+        defs_lines = file.readlines()
+    # A comment heavy source, with documentation blocks and trailing comments on every line
+    doc_lines = [ "/*\n", " * Documentation for the following definition\n", " */\n", "#define VALUE 1 // the value\n",
+                  "int a = VALUE; /* inline */ int b; // trailing\n", "const char * url = \"http://example.com\";\n" ]
+
+    def split_strip(line, in_comment):
+        if "//" in line:
+            line = line.split("//", 1)[0]
+        if in_comment:
+            line, comment = "", line
+        while True:
+            if in_comment:
+                if "*/" in comment:
+                    line += comment.split("*/", 1)[1]
+                    in_comment = False
+                else:
+                    break
+            else:
+                if "/*" in line:
+                    line, comment = line.split("/*", 1)
+                    in_comment = True
+                else:
+                    break
+        return line, in_comment
+
+    p = Preprocessor()
+    for name, lines in [("USB_Defs.h", defs_lines), ("documented", doc_lines * 40)]:
+        lines = lines * passes
+        for method, strip in [("split", split_strip), ("single pass", p._strip_comments)]:
+            def run():
+                in_comment = False
+                for line in lines:
+                    line, in_comment = strip(line, in_comment)
+            report("comments ({}, {})".format(name, method), len(lines), "lines", best_time(run))
+
+
+# Compares scanning the macro table for a family of constants against the indexed query
+def benchmark_macro_queries(families = 50, count = 100, passes = 20):
+    p = Preprocessor()
+    p.define("BASE", "0x100")
+    for i in range(families):
+        for j in range(count):
+            p.define("FAMILY{}_CONST{}".format(i, j), "(BASE + {})".format(j))
+    prefixes = [ "FAMILY{}_".format(i) for i in range(0, families, families // 5) ]
+
+    def scan():
+        for prefix in prefixes:
+            pattern = re.compile("^" + prefix)
+            values = {}
+            for name in p.macros:
+                if pattern.match(name):
+                    try:
+                        values[name] = p.evaluate(name)
+                    except Exception as e:
+                        values[name] = e
+
+    def query():
+        for prefix in prefixes:
+            p.evaluate_all(p.find_macros(prefix))
+
+    constants = len(prefixes) * count
+    for name, run in [("scan", scan), ("indexed", query)]:
+        report("macro queries ({})".format(name), constants * passes, "constants", best_time(lambda: [ run() for i in range(passes) ]))
+
+
+# Prints the change in throughput against the results of an earlier run
+def compare(results, baseline):
+    previous = { result["name"]: result for result in baseline }
+    for result in results:
+        if result["name"] in previous:
+            ratio = result["lines_per_second"] / previous[result["name"]]["lines_per_second"]
+            print("{:<40} {:>+11.1f}%".format(result["name"], (ratio - 1) * 100))
+
+# Run all the benchmarks
+def run_benchmarks(output = None, baseline = None):
+    results = benchmark_usb() + benchmark_stress()
+    benchmark_macro_calls()
+    benchmark_directives()
+    benchmark_comments()
+    benchmark_macro_queries()
+
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent = 2)
+    if baseline:
+        with open(baseline, "r") as file:
+            compare(results, json.load(file))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Measures preprocessor throughput")
+    parser.add_argument("--output", help = "file to save the results to, as JSON")
+    parser.add_argument("--baseline", help = "results of an earlier run to compare against")
+    args = parser.parse_args()
+    run_benchmarks(args.output, args.baseline)
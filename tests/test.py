@@ -1,9 +1,13 @@
 import os.path
+import asyncio
+import pickle
 import sys
+import tempfile
+import zipfile
 
 # Hack to include module in base directory
 sys.path.insert(0, os.path.abspath('./'))
-from preprocessor import Preprocessor
+from preprocessor import Preprocessor, AsyncDirectoryProvider, DictProvider, ZipProvider, PreprocessorState, SourceMap, Watcher, Directive, IncludeCache, EXPANSION_ENGINE_STRING, EXPANSION_ENGINE_TOKEN
 
 SRC_PATH = "tests/test_src"
 
@@ -283,6 +287,1015 @@ def test_include_source():
     p.include("usb/cdc/USB_CDC.c")
     p.source()
 
+# Tests that the token and string expansion engines produce the same source
+def test_expansion_engines():
+    sources = []
+    for engine in [EXPANSION_ENGINE_TOKEN, EXPANSION_ENGINE_STRING]:
+        p = Preprocessor()
+        p.expansion_engine = engine
+        p.ignore_missing_includes = True
+        p.add_include_path(SRC_PATH)
+        p.define("USB_ENABLE")
+        p.define("USB_CLASS_CDC")
+        p.include("usb/USB_CTL.c")
+        p.include("usb/cdc/USB_CDC.c")
+        sources.append(" ".join(p.source().split()))
+
+    test_assert(sources[0], sources[1])
+
+    # defined should also work without parentheses
+    p = Preprocessor()
+    p.define("MACRO_A", "1")
+    test_assert(p.evaluate("defined MACRO_A && defined(MACRO_A)"), True)
+
+    # Empty macros are removed by the token engine
+    p = Preprocessor()
+    p.include("source.c", "#define EMPTY\n")
+    test_assert(p.expand("EMPTY int a;"), " int a;")
+
+# Tests that included files are replayed from the include cache
+def test_include_cache():
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = os.path.join(directory, "cache")
+
+        def run_usb():
+            p = Preprocessor()
+            p.include_cache = IncludeCache(cache_dir)
+            p.ignore_missing_includes = True
+            p.add_include_path(SRC_PATH)
+            p.define("USB_ENABLE")
+            p.define("USB_CLASS_CDC")
+            p.include("usb/cdc/USB_CDC.c")
+            return p
+
+        first = run_usb()
+        second = run_usb()
+        test_assert(first.include_cache.hits, 0)
+        test_assert(second.include_cache.hits, 1)
+        test_assert(second.source(), first.source())
+        test_assert(second.evaluate("CDC_BFR_WRAP(513)"), 1)
+
+        # A different macro state must not replay the entry
+        p = Preprocessor()
+        p.include_cache = IncludeCache(cache_dir)
+        p.ignore_missing_includes = True
+        p.add_include_path(SRC_PATH)
+        p.define("USB_CLASS_MSC")
+        p.include("usb/USB_Class.h")
+        test_assert(p.expand("USB_CLASS_INIT(0)"), "USB_MSC_Init(0)")
+
+        # Changing a nested include must invalidate the including file
+        src_dir = os.path.join(directory, "src")
+        os.mkdir(src_dir)
+        with open(os.path.join(src_dir, "main.h"), "w") as file:
+            file.write('#include "value.h"\n#define MAIN_VALUE (VALUE + 1)\n')
+        for value in ["1", "2"]:
+            with open(os.path.join(src_dir, "value.h"), "w") as file:
+                file.write("#define VALUE {}\n// padding to change the size {}\n".format(value, value * int(value)))
+            p = Preprocessor()
+            p.include_cache = IncludeCache(cache_dir)
+            p.include(os.path.join(src_dir, "main.h"))
+            test_assert(p.evaluate("MAIN_VALUE"), int(value) + 1)
+
+        # Macros looked up by source lines must be recorded, even where no macro is defined yet
+        with open(os.path.join(src_dir, "lookups.h"), "w") as file:
+            file.write("int x = FOO;\n#if BAR\nint bar;\n#endif\n")
+        for defined in [False, True]:
+            p = Preprocessor()
+            p.include_cache = IncludeCache(cache_dir)
+            if defined:
+                p.define("FOO", "1")
+                p.define("BAR", "1")
+            p.include(os.path.join(src_dir, "lookups.h"))
+            test_assert(p.source(), "int x = 1;\nint bar;\n" if defined else "int x = FOO;\n")
+
+        # Caches sharing a directory must keep it within max_size, and tolerate entries removed by each other
+        shared_dir = os.path.join(directory, "shared")
+        first = IncludeCache(shared_dir, max_size = 100)
+        second = IncludeCache(shared_dir, max_size = 100)
+        entry = { "consulted": {}, "padding": "x" * 40 }
+        first.store("a", entry)
+        second.store("b", entry)
+        first.store("c", entry)
+        sizes = [ os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(shared_dir) for name in names ]
+        test_assert(len(sizes), 1)
+        test_assert(first.lookup("c", lambda entry: True), entry)
+        first._touch(os.path.join(shared_dir, "b", "removed.json"))
+        test_assert(second.lookup("a", lambda entry: True), None)
+
+# Tests that guarded and #pragma once headers are not included twice
+def test_include_guards():
+    p = Preprocessor()
+    p.ignore_missing_includes = True
+    p.add_include_path(SRC_PATH)
+    p.define("USB_ENABLE")
+    p.define("USB_CLASS_CDC")
+    p.include("usb/USB_CTL.c")
+    p.include("usb/USB_EP.c")
+    test_assert(p.skipped_includes > 0, True)
+
+    with tempfile.TemporaryDirectory() as src_dir:
+        headers = {
+            "guarded.h": "// leading comment\n#ifndef GUARDED_H\n#define GUARDED_H\nint guarded;\n#endif\n",
+            "once.h": "#pragma once\nint once;\n",
+            "unguarded.h": "#ifndef UNGUARDED_H\n#define UNGUARDED_H\n#endif\nint unguarded;\n",
+        }
+        for name, body in headers.items():
+            with open(os.path.join(src_dir, name), "w") as file:
+                file.write(body)
+
+        p = Preprocessor()
+        p.add_include_path(src_dir)
+        for i in range(3):
+            for name in headers:
+                p.include(name)
+        test_assert(p.skipped_includes, 4)
+        test_assert(" ".join(p.source().split()), "int guarded; int once; int unguarded; int unguarded; int unguarded;")
+
+        # An undefined guard macro allows the header to be included again
+        p.undefine("GUARDED_H")
+        p.include("guarded.h")
+        test_assert(p.source().count("int guarded;"), 2)
+
+# Tests that custom directives can be registered
+def test_custom_directives():
+    warnings = []
+    p = Preprocessor()
+    p.add_directive(Directive(r"#\s*warning\s+(.*)", lambda args: warnings.append(args[0])))
+    p.include("source.c", """
+    #define MACRO_A 1
+    #warning first
+    #if 0
+    #warning skipped
+    #endif
+    # warning second
+    """)
+    test_assert(warnings, ["first", "second"])
+    test_assert(p.expand("MACRO_A"), "1")
+
+# Tests that comments are removed, without disturbing literals that look like comments
+def test_comments():
+    p = Preprocessor()
+    p.include("source.c", """// leading comment
+#define URL "http://example.com/*" // a url
+#define SPACED int/* a comment */x
+int a; // trailing comment
+char b = '/'; int/**/c; /* // */ int d;
+const char * e = "\\"/* not a comment */"; /* a comment
+int f;
+*/ int g; // continued \\
+int h;
+""")
+    test_assert(p.source(), "int a; \nchar b = '/'; int c;   int d;\nconst char * e = \"\\\"/* not a comment */\"; \n int g; \n")
+    test_assert(p.expand("URL"), '"http://example.com/*"')
+    test_assert(p.expand("SPACED"), "int x")
+
+# Tests that inactive #if blocks are skipped correctly
+def test_skipped_blocks():
+    p = Preprocessor()
+    p.include("source.c", """
+    #if 0
+    int a;
+    #if 1
+    int b;
+    #else
+    int c;
+    #endif
+    /* a comment hiding a directive
+    #endif
+    */
+    int d; \\
+    #endif
+    #define MACRO_A 1
+    #else
+    int e;
+    #endif
+    """)
+    test_assert(" ".join(p.source().split()), "int e;")
+    test_assert(p.is_defined("MACRO_A"), False)
+    test_assert(p.skipped_lines, 3)
+
+# Tests that expressions are evaluated with C semantics
+def test_c_expressions():
+    p = Preprocessor()
+    p.define("MACRO_CONST", "4UL")
+
+    test_assert(p.evaluate("-7 / 2"), -3)
+    test_assert(p.evaluate("-7 % 2"), -1)
+    test_assert(p.evaluate("MACRO_CONST > 2 ? 10 : 20"), 10)
+    test_assert(p.evaluate("0 ? 1 : 0 ? 2 : 3"), 3)
+    test_assert(p.evaluate("-1 < 0U"), 0)
+    test_assert(p.evaluate("0xFFFFFFFFFFFFFFFF + 1"), 0)
+    test_assert(p.evaluate("1UL << 63"), 1 << 63)
+    test_assert(p.evaluate("'A' + '\\n'"), 75)
+    test_assert(p.evaluate("1 || (1 / 0)"), 1)
+    test_assert(p.evaluate("2 * 3 + 4 * 5 - 6 % 4"), 24)
+
+    # Unknown identifiers are an error, but are 0 within #if
+    try:
+        p.evaluate("MACRO_UNKNOWN + 1")
+        test_assert("The expression above should fail.", None)
+    except:
+        pass
+    p.include("source.c", """
+    #if !MACRO_UNKNOWN && MACRO_CONST == 4
+    #define MACRO_A 1
+    #endif
+    """)
+    test_assert(p.is_defined("MACRO_A"), True)
+
+# Tests that memoized expansions are invalidated when macros change
+def test_expansion_cache():
+    p = Preprocessor()
+    p.define("MACRO_BASE", "1")
+    p.define("MACRO_CONST", "(MACRO_BASE + 1)")
+    p.define("MACRO_CHAIN", "(MACRO_CONST * 2)")
+    p.define("MACRO_CALL", "MACRO_A")
+    p.define("MACRO_A", "(a + 1)", ["a"])
+
+    test_assert(p.evaluate("MACRO_CHAIN"), 4)
+    test_assert(p.evaluate("MACRO_CHAIN"), 4)
+    test_assert(p.expansion_cache_hits, 1)
+    test_assert(p.expansion_cache_misses, 1)
+
+    p.define("MACRO_BASE", "2")
+    test_assert(p.evaluate("MACRO_CHAIN"), 6)
+    test_assert(p.expansion_cache_misses, 2)
+
+    # Chained constants are cached, but must still consume following arguments
+    test_assert(p.expand("MACRO_CALL(MACRO_CHAIN)"), "(((2 + 1) * 2) + 1)")
+    p.undefine("MACRO_A")
+    test_assert(p.expand("MACRO_CALL(MACRO_CHAIN)"), "MACRO_A(((2 + 1) * 2))")
+
+    # Long expansions are used, but not cached, so a chain of constants does not cache a quadratic number of tokens
+    p = Preprocessor()
+    p.define("MACRO_LINK0", "0")
+    for i in range(1, 200):
+        p.define("MACRO_LINK{}".format(i), "(MACRO_LINK{} + 1)".format(i - 1))
+    test_assert(p.evaluate("MACRO_LINK10"), 10)
+    test_assert(p.evaluate("MACRO_LINK199"), 199)
+    test_assert(p.evaluate("MACRO_LINK199"), 199)
+    test_assert(len(p.macros["MACRO_LINK10"]._expanded), 61)
+    test_assert(p.macros["MACRO_LINK199"]._expanded, None)
+
+# Tests that source can be streamed rather than stored
+def test_iter_source():
+    def create():
+        p = Preprocessor()
+        p.ignore_missing_includes = True
+        p.add_include_path(SRC_PATH)
+        p.define("USB_ENABLE")
+        p.define("USB_CLASS_CDC")
+        return p
+
+    p = create()
+    p.include("usb/USB_CTL.c")
+
+    streamed = create()
+    lines = streamed.iter_source("usb/USB_CTL.c")
+    test_assert(next(lines), p.source_lines[0])
+    test_assert("".join(lines), "".join(p.source_lines[1:]))
+    test_assert(streamed.source_lines, [])
+    test_assert(streamed.expand("CTL_EP_SIZE"), "64")
+
+    # Abandoning a stream part way through a nested file restores the state of the outer file
+    p = Preprocessor()
+    p.file_provider = DictProvider({
+        "d/inner.h": "#if 1\nint inner;\nint inner_end;\n#endif\n",
+        "d/other.h": "int wrong;\n",
+        "other.h": "int other;\n",
+    })
+    for line in p.iter_source("main.c", "#include \"d/inner.h\"\n"):
+        break
+    test_assert(p._local_path, "")
+    test_assert(p._enable_stack, [])
+    p.include("other.h")
+    test_assert(p.source(), "int other;\n")
+
+# Tests that a batch of files may be preprocessed in parallel
+def test_preprocess_batch():
+    paths = ["usb/USB_CTL.c", "usb/USB_EP.c", "usb/cdc/USB_CDC.c"]
+    base = Preprocessor()
+    base.ignore_missing_includes = True
+    base.add_include_path(SRC_PATH)
+    base.define("USB_ENABLE")
+    base.define("USB_CLASS_CDC")
+
+    expected = []
+    for path in paths:
+        p = Preprocessor()
+        p.ignore_missing_includes = True
+        p.add_include_path(SRC_PATH)
+        p.define("USB_ENABLE")
+        p.define("USB_CLASS_CDC")
+        p.include(path)
+        expected.append(p.source())
+
+    for processes in [1, 2]:
+        results = base.preprocess_batch(paths, processes)
+        test_assert([ result.path for result in results ], paths)
+        test_assert([ result.source for result in results ], expected)
+        test_assert(results[2].macros["CDC_IN_EP"].expr, "0x81")
+    test_assert(base.source_lines, [])
+
+# Tests that a preprocessor can be restored from a snapshot of its state, and forked
+def test_snapshot():
+    prelude = Preprocessor()
+    prelude.ignore_missing_includes = True
+    prelude.add_include_path(SRC_PATH)
+    prelude.define("USB_ENABLE")
+    prelude.include("prelude.h", "#define A 1\nint a = A;\n#include \"usb/USB_Defs.h\"\n")
+    prelude_source = prelude.source()
+    state = prelude.snapshot()
+
+    # forks share the prelude until they modify it
+    p1 = prelude.fork(state)
+    p2 = prelude.fork(state)
+    p1.define("B", "2")
+    p2.undefine("A")
+    test_assert(p1.evaluate("A + B"), 3)
+    test_assert(p2.is_defined("A"), False)
+    test_assert(prelude.is_defined("A"), True)
+    test_assert(prelude.is_defined("B"), False)
+
+    # include paths and guards are restored
+    p1.include("unit.c", "#include \"usb/USB_Defs.h\"\nint b = B;\n")
+    test_assert(p1.source(), prelude_source + "int b = 2;\n")
+    test_assert(p1.skipped_includes, 1)
+    test_assert(prelude.source(), prelude_source)
+
+    # the prelude itself is unaffected by its snapshot
+    prelude.define("A", "4")
+    test_assert(p2.fork().is_defined("A"), False)
+    test_assert(Preprocessor().fork(state).evaluate("A"), 1)
+
+    # snapshots may be stored for use by other processes
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "prelude.pickle")
+        state.save(path)
+        p3 = Preprocessor()
+        p3.restore(PreprocessorState.load(path))
+        test_assert(p3.evaluate("A + 1"), 2)
+        p3.include("unit.c", "int c = A;\n")
+        test_assert(p3.source(), prelude_source + "int c = 1;\n")
+
+# Tests that files are decoded with the configured encoding and any line endings
+def test_file_encoding():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "encoded.h")
+        with open(path, "wb") as file:
+            file.write("#define NAME \"caf\u00e9\"\r\nconst char * a = NAME;\rint b;\n#if 0\r\nskipped\r\n#endif\r\nint c;".encode("latin-1"))
+
+        expected = "const char * a = \"caf\u00e9\";\nint b;\nint c;"
+        for use_mmap in [False, True]:
+            p = Preprocessor()
+            p.use_mmap = use_mmap
+            p.encoding = "latin-1"
+            p.include(path)
+            test_assert(p.source(), expected)
+
+            # invalid bytes can be replaced rather than raising an error
+            p = Preprocessor()
+            p.use_mmap = use_mmap
+            p.encoding = "utf-8"
+            p.encoding_errors = "replace"
+            p.include(path)
+            test_assert(p.source(), expected.replace("\u00e9", "\ufffd"))
+
+        # empty files cannot be mapped, but are still read
+        path = os.path.join(directory, "empty.h")
+        open(path, "w").close()
+        p = Preprocessor()
+        p.use_mmap = True
+        p.include(path)
+        test_assert(p.source(), "")
+
+# Tests that profiling records time spent in each phase and macro
+def test_profiling():
+    for engine in [EXPANSION_ENGINE_TOKEN, EXPANSION_ENGINE_STRING]:
+        p = Preprocessor()
+        p.expansion_engine = engine
+        p.ignore_missing_includes = True
+        p.add_include_path(SRC_PATH)
+        p.define("USB_CLASS_CDC")
+        profile = p.enable_profiling()
+        p.include("usb/cdc/USB_CDC.c")
+        test_assert(p.evaluate("CDC_IN_EP"), 0x81)
+
+        for phase in ["include", "strip_comments", "directives", "expand_macros", "evaluate"]:
+            test_assert(profile.phases[phase].calls > 0, True)
+        test_assert(profile.files[os.path.join(SRC_PATH, "usb/cdc/USB_CDC.c")].calls, 1)
+        test_assert(len(profile.files) > 1, True)
+        test_assert(profile.macros["CDC_IN_EP"].calls > 0, True)
+        test_assert("CDC_IN_EP" in profile.report(), True)
+
+        # once disabled, nothing more is recorded
+        test_assert(p.disable_profiling(), profile)
+        calls = profile.phases["evaluate"].calls
+        test_assert(p.evaluate("CDC_OUT_EP"), 0x01)
+        test_assert(profile.phases["evaluate"].calls, calls)
+        test_assert("_evaluate" in p.__dict__, False)
+
+# Tests that resolved include paths are cached without changing the output
+def test_path_cache():
+    expected = None
+    for index_directories in [False, True]:
+        p = Preprocessor()
+        p.index_directories = index_directories
+        p.ignore_missing_includes = True
+        p.add_include_path(SRC_PATH)
+        p.define("USB_CLASS_CDC")
+        p.include("usb/cdc/USB_CDC.c")
+        if expected is None:
+            expected = p.source()
+        test_assert(p.source(), expected)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for index_directories in [False, True]:
+            p = Preprocessor()
+            p.index_directories = index_directories
+            p.ignore_missing_includes = True
+            p.add_include_path(directory)
+            source = "#include \"late.h\"\n"
+
+            # missing files are remembered
+            p.include("a.c", source)
+            path = os.path.join(directory, "late.h")
+            with open(path, "w") as file:
+                file.write("int late;\n")
+            p.include("b.c", source)
+            test_assert(p.source(), "")
+
+            # until the cache is cleared
+            p.clear_path_cache()
+            p.include("c.c", source)
+            test_assert(p.source(), "int late;\n")
+            os.remove(path)
+
+            # changing the include paths also clears the cache
+            p.include_paths = [SRC_PATH]
+            p.include("d.c", "#include \"usb/USB_Defs.h\"\n")
+            test_assert(p.is_defined("USB_DEFS_H"), True)
+
+# Tests that changed files are detected, and only the affected sources are preprocessed again
+def test_watcher():
+    with tempfile.TemporaryDirectory() as directory:
+        def write(name, text):
+            with open(os.path.join(directory, name), "w") as file:
+                file.write(text)
+        write("config.h", "#define VALUE 1\n")
+        write("a.c", "#include \"config.h\"\nint a = VALUE;\n")
+        write("b.h", "#define B 2\n")
+        write("b.c", "#include \"b.h\"\nint b = B + VALUE;\n")
+
+        p = Preprocessor()
+        p.define("BASE")
+        watcher = Watcher(p, [os.path.join(directory, "a.c"), os.path.join(directory, "b.c")])
+        test_assert(p.source(), "int a = 1;\nint b = 2 + 1;\n")
+        test_assert(watcher.update(), [])
+
+        # only the file that reads a changed header is processed
+        write("b.h", "#define B 20\n")
+        test_assert(watcher.update(), [os.path.join(directory, "b.c")])
+        test_assert(p.source(), "int a = 1;\nint b = 20 + 1;\n")
+        test_assert(p.evaluate("B"), 20)
+
+        # later files are processed if their starting macros change
+        write("config.h", "#define VALUE 3\n")
+        test_assert(len(watcher.update()), 2)
+        test_assert(p.source(), "int a = 3;\nint b = 20 + 3;\n")
+
+        # but not if the macros are the same
+        write("config.h", "// a comment\n#define VALUE 3\n")
+        test_assert(watcher.update(), [os.path.join(directory, "a.c")])
+        test_assert(p.is_defined("BASE"), True)
+
+        # a failed file is retried on the next update
+        write("b.h", "#if 1\n")
+        failed = False
+        try:
+            watcher.update()
+        except Exception:
+            failed = True
+        test_assert(failed, True)
+        write("b.h", "#define B 4\n")
+        test_assert(watcher.update(), [os.path.join(directory, "b.c")])
+        test_assert(p.source(), "int a = 3;\nint b = 4 + 3;\n")
+
+        # an ignored missing header is read once it is created
+        write("late.c", "#include \"late.h\"\nint late = LATE;\n")
+        p = Preprocessor()
+        p.ignore_missing_includes = True
+        watcher = Watcher(p, [os.path.join(directory, "late.c")])
+        test_assert(p.source(), "int late = LATE;\n")
+        test_assert(watcher.update(), [])
+        write("late.h", "#define LATE 5\n")
+        test_assert(watcher.update(), [os.path.join(directory, "late.c")])
+        test_assert(p.source(), "int late = 5;\n")
+        test_assert(watcher.update(), [])
+
+# Tests that the include dependency graph is built without expanding source
+def test_dependencies():
+    p = Preprocessor()
+    p.ignore_missing_includes = True
+    p.add_include_path(SRC_PATH)
+    p.define("USB_CLASS_CDC")
+    p.include_rule = lambda name: name != "../USB_CTL.h"
+    graph = p.dependencies("usb/cdc/USB_CDC.c")
+
+    usb_path = os.path.join(SRC_PATH, "usb")
+    test_assert(list(graph), [
+        os.path.join(usb_path, "cdc", "USB_CDC.c"),
+        os.path.join(usb_path, "cdc", "USB_CDC.h"),
+        os.path.join(usb_path, "USB_Defs.h"),
+        os.path.join(usb_path, "USB_EP.h"),
+    ])
+    test_assert(graph[os.path.join(usb_path, "cdc", "USB_CDC.h")], [os.path.join(usb_path, "USB_Defs.h")])
+    test_assert(p.source_lines, [])
+    test_assert(p.is_defined("CDC_IN_EP"), True)
+
+    # conditionals are honored
+    p = Preprocessor()
+    p.ignore_missing_includes = True
+    p.add_include_path(SRC_PATH)
+    source = "#ifdef USE_DEFS\n#include \"usb/USB_Defs.h\"\n#endif\nint a = MISSING(;\n"
+    test_assert(list(p.dependencies("main.c", source)), ["main.c"])
+    p.define("USE_DEFS")
+    test_assert(list(p.dependencies("main.c", source)), ["main.c", os.path.join(usb_path, "USB_Defs.h")])
+
+    p = Preprocessor()
+    p.ignore_missing_includes = True
+    p.add_include_path(SRC_PATH)
+    test_assert(p.dependency_rule("usb/cdc/USB_CDC.h"), "USB_CDC.o: \\\n  {} \\\n  {}\n".format(
+        os.path.join(usb_path, "cdc", "USB_CDC.h"), os.path.join(usb_path, "USB_Defs.h")))
+
+# Tests that macros can be collected without expanding any source
+def test_macros_only():
+    source = """
+#define A 1 /* a comment
+#define B 2 */
+#define C(x) \\
+    (x + A)
+int a = C(
+    A);
+/* #define D 3 */
+#if C(1) == 2
+#define E 5
+#endif
+"""
+    full = Preprocessor()
+    full.ignore_missing_includes = True
+    full.add_include_path(SRC_PATH)
+    full.include("macros.c", source)
+    full.include("usb/USB_Defs.h")
+
+    p = Preprocessor()
+    p.expand_source = False
+    p.ignore_missing_includes = True
+    p.add_include_path(SRC_PATH)
+    p.include("macros.c", source)
+    p.include("usb/USB_Defs.h")
+    test_assert(p.source(), "")
+    test_assert(sorted(p.macros), sorted(full.macros))
+    test_assert(p.is_defined("B"), False)
+    test_assert(p.expand("C(E)"), "(5 + 1)")
+    test_assert(p.expand("USB_MAX_POWER_MA"), full.expand("USB_MAX_POWER_MA"))
+
+# Tests that function-like macros substitute their arguments correctly with both engines
+def test_macro_templates():
+    for engine in [EXPANSION_ENGINE_TOKEN, EXPANSION_ENGINE_STRING]:
+        p = Preprocessor()
+        p.expansion_engine = engine
+        p.define("F", "a + b*a - ab", ["a", "b"])
+        p.define("G", "f(n, __VA_ARGS__)", ["n", "..."])
+        p.define("H", "n + m", ["n", "m", "..."])
+        p.define("INVALID", "a", ["a...", "b"])
+
+        test_assert(p.expand("F(1, 2)"), "1 + 2*1 - ab")
+        test_assert(p.expand("G(1, 2,3)"), "f(1,  2,3)")
+        test_assert(p.expand("G(1)"), "f(1, )")
+        # parameters without arguments are left in place
+        test_assert(p.expand("H(1)"), "1 + m")
+
+        # invalid parameters are reported when the macro is used
+        failed = False
+        try:
+            p.expand("INVALID(1, 2)")
+        except ValueError:
+            failed = True
+        test_assert(failed, True)
+
+    # templates survive pickling
+    macro = pickle.loads(pickle.dumps(p.macros["F"]))
+    test_assert(macro.expand(["x", "y"]), "x + y*x - ab")
+    test_assert(macro.expand_tokens([["x"], ["y"]]), ["x", " ", "+", " ", "y", "*", "x", " ", "-", " ", "ab"])
+    test_assert(hasattr(macro, "__dict__"), False)
+
+# Examples from the C99 standard, section 6.10.3.5
+def test_macro_operators():
+    def expand_all(src, exprs):
+        p = Preprocessor()
+        p.include("source.c", src)
+        return [ "".join(p.expand(expr).split()) for expr in exprs ]
+
+    src = """
+    #define x 3
+    #define f(a) f(x * (a))
+    #undef x
+    #define x 2
+    #define g f
+    #define z z[0]
+    #define h g(~
+    #define m(a) a(w)
+    #define w 0,1
+    #define t(a) a
+    #define p() int
+    #define q(x) x
+    #define r(x,y) x ## y
+    #define str(x) # x
+    """
+    test_assert(expand_all(src, [
+        "f(y+1) + f(f(z)) % t(t(g)(0) + t)(1);",
+        "g(x+(3,4)-w) | h 5) & m(f)^m(m);",
+        "p() i[q()] = { q(1), r(2,3), r(4,), r(,5), r(,) };",
+        "char c[2][6] = { str(hello), str() };",
+    ]), [
+        "f(2*(y+1))+f(2*(f(2*(z[0]))))%f(2*(0))+t(1);",
+        "f(2*(2+(3,4)-0,1))|f(2*(~5))&f(2*(0,1))^m(0,1);",
+        "inti[]={1,23,4,5,};",
+        'charc[2][6]={"hello",""};',
+    ])
+
+    src = """
+    #define str(s) # s
+    #define xstr(s) str(s)
+    #define debug(s, t) printf("x" # s "= %d, x" # t "= %s", \\
+        x ## s, x ## t)
+    #define INCFILE(n) vers ## n
+    #define glue(a, b) a ## b
+    #define xglue(a, b) glue(a, b)
+    #define HIGHLOW "hello"
+    #define LOW LOW ", world"
+    #define hash_hash # ## #
+    #define mkstr(a) # a
+    #define in_between(a) mkstr(a)
+    #define join(c, d) in_between(c hash_hash d)
+    #define showlist(...) puts(#__VA_ARGS__)
+    """
+    test_assert(expand_all(src, [
+        "debug(1, 2);",
+        'fputs(str(strncmp("abc\\0d", "abc", \'\\4\') == 0) str(: @\\n), s);',
+        "xstr(INCFILE(2).h)",
+        "glue(HIGH, LOW);",
+        "xglue(HIGH, LOW)",
+        "join(x, y)",
+        "showlist(The first, second, and third items.);",
+    ]), [
+        'printf("x""1""=%d,x""2""=%s",x1,x2);',
+        'fputs("strncmp(\\"abc\\\\0d\\",\\"abc\\",\'\\\\4\')==0"":@\\n",s);',
+        '"vers2.h"',
+        '"hello";',
+        '"hello"",world"',
+        '"x##y"',
+        'puts("Thefirst,second,andthirditems.");',
+    ])
+
+    # Identifiers built by pasting are expanded, and commas before empty variadic arguments are removed
+    p = Preprocessor()
+    p.define("USB_EP1_IRQ", "17")
+    p.define("EP_IRQ", "USB_EP##n##_IRQ", ["n"])
+    p.define("LOG", "printf(fmt, ## __VA_ARGS__)", ["fmt", "..."])
+    test_assert(p.evaluate("EP_IRQ(1)"), 17)
+    test_assert(p.expand('LOG("a")'), 'printf("a")')
+    test_assert(p.expand('LOG("a", 1)'), 'printf("a", 1)')
+
+    # Macros are not expanded within their own expansion
+    p = Preprocessor()
+    p.define("A", "B + 1")
+    p.define("B", "A * 2")
+    p.define("C", "C")
+    p.define("F", "F(x)", ["x"])
+    test_assert(p.expand("A"), "A * 2 + 1")
+    test_assert(p.expand("C + C"), "C + C")
+    test_assert(p.expand("F(F(1))"), "F(F(1))")
+
+    # A call continued on the next line is expanded once, with the rest of its line
+    p = Preprocessor()
+    p.define("C", "C + 1")
+    p.define("F", "x", ["x"])
+    p.include("source.c", "int a = C F(\n2);\n")
+    test_assert(p.source(), "int a = C + 1 2;\n")
+
+# Tests that output lines are mapped back to the file and line they came from
+def test_source_map():
+    source = """#include "usb/USB_Defs.h"
+#define F(x, y) (x + y)
+int a = F(1,
+          2);
+int b = \\
+  3;
+#if 0
+int c;
+#endif
+
+
+
+
+int d;
+"""
+    p = Preprocessor()
+    p.ignore_missing_includes = True
+    p.add_include_path(SRC_PATH)
+    p.line_markers = True
+    p.source_map = SourceMap()
+    p.include("main.c", source)
+
+    lines = p.source().splitlines()
+    start = lines.index('# 3 "main.c"')
+    test_assert(lines[start:], [
+        '# 3 "main.c"',
+        "int a = (1 + 2);",
+        "",
+        "int b =   3;",
+        "", "", "", "", "", "", "", "",
+        "int d;",
+    ])
+    test_assert(lines[0].startswith("# "), True)
+
+    # every output line maps back to its origin
+    test_assert(p.source_map.output_lines, len(lines))
+    test_assert(p.source_map.origin(start + 2), ("main.c", 3))
+    test_assert(p.source_map.origin(start + 4), ("main.c", 5))
+    test_assert(p.source_map.origin(len(lines)), ("main.c", 14))
+    test_assert(p.source_map.origin(len(lines) + 1), None)
+    path, line = p.source_map.origin(start)
+    with open(path) as file:
+        test_assert(file.readlines()[line - 1].strip(), lines[start - 1].strip())
+
+    # Without markers, the map alone describes the output. Consecutive lines share a run.
+    p = Preprocessor()
+    p.source_map = SourceMap()
+    p.include("main.c", "int a;\nint b;\n#define X\nint c;\n")
+    test_assert(p.source(), "int a;\nint b;\nint c;\n")
+    test_assert([ p.source_map.origin(i) for i in range(1, 4) ], [("main.c", 1), ("main.c", 2), ("main.c", 4)])
+    test_assert(len(p.source_map), 2)
+
+    # Markers are kept by forks and batch workers
+    p = Preprocessor()
+    p.line_markers = True
+    p.include("prelude.h", "int a;\n")
+    unit = p.fork()
+    unit.include("main.c", "int b;\n")
+    test_assert(unit.source(), '# 1 "prelude.h"\nint a;\n# 1 "main.c"\nint b;\n')
+    p.ignore_missing_includes = True
+    path = os.path.join(SRC_PATH, "usb", "USB_CTL.c")
+    test_assert(p.preprocess_batch([path], processes = 1)[0].source.startswith('# '), True)
+
+# Tests that files can be read concurrently by an async include
+def test_include_async():
+    def make_preprocessor():
+        p = Preprocessor()
+        p.ignore_missing_includes = True
+        p.add_include_path(SRC_PATH)
+        p.define("USB_CLASS_CDC")
+        return p
+
+    expected = make_preprocessor()
+    expected.include("usb/cdc/USB_CDC.c")
+
+    # Files in memory, fetched with some latency. Every fetch should be in flight at once.
+    class SlowProvider():
+        def __init__(self, files):
+            self.files = files
+            self.pending = 0
+            self.max_pending = 0
+        async def fetch(self):
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+            await asyncio.sleep(0.01)
+            self.pending -= 1
+        async def exists(self, path):
+            await self.fetch()
+            return path in self.files
+        async def read(self, path):
+            await self.fetch()
+            return self.files[path]
+
+    files = {}
+    for path in make_preprocessor().dependencies("usb/cdc/USB_CDC.c"):
+        with open(path, "r") as file:
+            files[path] = file.read()
+    provider = SlowProvider(files)
+
+    async def run_jobs():
+        jobs = [ make_preprocessor() for i in range(4) ]
+        await asyncio.gather(*[ p.include_async("usb/cdc/USB_CDC.c", provider = provider) for p in jobs ])
+        return jobs
+
+    for p in asyncio.run(run_jobs()):
+        test_assert(p.source(), expected.source())
+        test_assert(p.macros.keys(), expected.macros.keys())
+    test_assert(provider.max_pending >= 4, True)
+
+    # The local filesystem is used by default
+    p = make_preprocessor()
+    asyncio.run(p.include_async("main.c", "#include \"usb/USB_Defs.h\"\nint a = USB_VID;\n"))
+    test_assert(p.source_lines[-1], "int a = 0x0483;\n")
+
+    p = Preprocessor()
+    p.ignore_missing_includes = True
+    asyncio.run(p.include_async("main.c", "#include \"USB_Defs.h\"\n", provider = AsyncDirectoryProvider(os.path.join(SRC_PATH, "usb"))))
+    test_assert(p.is_defined("USB_VID"), True)
+
+    failed = False
+    try:
+        asyncio.run(p.include_async("missing.h"))
+    except Exception:
+        failed = True
+    test_assert(failed, True)
+
+# Tests that files can be read from memory and from zip archives
+def test_file_providers():
+    def make_preprocessor(provider, include_path):
+        p = Preprocessor()
+        p.ignore_missing_includes = True
+        p.add_include_path(include_path)
+        p.define("USB_CLASS_CDC")
+        p.file_provider = provider
+        return p
+
+    expected = make_preprocessor(None, SRC_PATH)
+    expected.include(os.path.join(SRC_PATH, "usb/cdc/USB_CDC.c"))
+
+    # A whole source tree can be read from an archive
+    with tempfile.TemporaryDirectory() as directory:
+        archive = os.path.join(directory, "src.zip")
+        with zipfile.ZipFile(archive, "w") as file:
+            for root, dirs, names in os.walk(SRC_PATH):
+                for name in names:
+                    path = os.path.join(root, name)
+                    file.write(path, os.path.relpath(path, SRC_PATH))
+
+        provider = ZipProvider(archive)
+        for index_directories in [False, True]:
+            p = make_preprocessor(provider, "")
+            p.index_directories = index_directories
+            p.include("usb/cdc/USB_CDC.c")
+            test_assert(p.source(), expected.source())
+            test_assert(p.macros.keys(), expected.macros.keys())
+
+        # providers opened from a path can be sent to batch workers
+        p = make_preprocessor(pickle.loads(pickle.dumps(provider)), "")
+        test_assert(p.preprocess_batch(["usb/cdc/USB_CDC.c"], processes = 1)[0].source, expected.source())
+        provider.archive.close()
+
+    # Files can be supplied from memory. Nested includes are found through the provider.
+    files = {
+        "main.c": "#include \"config.h\"\n#include <lib/lib.h>\nint a = VALUE + LIB;\n",
+        "config.h": "#define VALUE 1\n",
+        "include/lib/lib.h": "#include \"version.h\"\n#define LIB VERSION\n",
+        "include/lib/version.h": "#define VERSION 2\n",
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        archive = os.path.join(directory, "files.zip")
+        with zipfile.ZipFile(archive, "w") as file:
+            for path, text in files.items():
+                file.writestr(path, text)
+
+        # top level files are found in directory listings
+        provider = ZipProvider(archive)
+        for p in [make_preprocessor(provider, "include"), make_preprocessor(DictProvider(files), "include")]:
+            p.index_directories = True
+            p.include("main.c")
+            test_assert(p.source(), "int a = 1 + 2;\n")
+        provider.archive.close()
+
+    p = make_preprocessor(DictProvider(files), "include")
+    p.include("main.c")
+    test_assert(p.source(), "int a = 1 + 2;\n")
+    test_assert(list(p.dependencies("main.c")), ["main.c", "config.h", os.path.join("include", "lib", "lib.h"), os.path.join("include", "lib", "version.h")])
+
+    failed = False
+    try:
+        p.include("missing.c")
+    except Exception:
+        failed = True
+    test_assert(failed, True)
+
+# Tests that macros can be found by prefix, suffix or pattern, and evaluated together
+def test_macro_queries():
+    p = Preprocessor()
+    p.ignore_missing_includes = True
+    p.add_include_path(SRC_PATH)
+    p.define("USB_CLASS_CDC")
+    p.include("usb/cdc/USB_CDC.c")
+
+    test_assert(p.find_macros("CDC_", "_EP$"), ["CDC_CMD_EP", "CDC_IN_EP", "CDC_OUT_EP"])
+    test_assert(p.find_macros("USB_CLASS"), ["USB_CLASS_CDC"])
+    test_assert(p.find_macros("MISSING"), [])
+    test_assert(p.find_macros(pattern = "^CDC_.*_LINE_CODING$"), ["CDC_GET_LINE_CODING", "CDC_SET_LINE_CODING"])
+    test_assert(p.find_macros(), sorted(p.macros))
+
+    # The index follows changes to the macros
+    p.define("USB_CLASS_MSC")
+    p.undefine("USB_CLASS_CDC")
+    test_assert(p.find_macros("USB_CLASS"), ["USB_CLASS_MSC"])
+
+    values = p.evaluate_all(p.find_macros("CDC_", "_EP$") + ["CDC_BFR_WRAP", "CDC_IN_EP + 1"])
+    test_assert({ name: value for name, value in values.items() if not isinstance(value, Exception) },
+        { "CDC_CMD_EP": 0x82, "CDC_IN_EP": 0x81, "CDC_OUT_EP": 0x01, "CDC_IN_EP + 1": 0x82 })
+    test_assert(isinstance(values["CDC_BFR_WRAP"], Exception), True)
+
+# Tests that lazily expanded lines use the macros defined when they were read
+def test_lazy_expansion():
+    source = """
+#define X 1
+#define F(a, b) (a + b)
+int a = X;
+#undef X
+#define X 2
+int b = F(X,
+          X);
+int c = F
+    (X, 3);
+#define X 3
+int d = F(X, X);
+#define MACRO(x) [x]
+int e[] = { foo(1,
+    2), MACRO(
+    3) };
+int f = F(")", MACRO(
+    4));
+"""
+    expected = Preprocessor()
+    expected.include("source.c", source)
+
+    p = Preprocessor()
+    p.lazy_expansion = True
+    p.include("source.c", source)
+    # lines are only expanded as they are read
+    test_assert(p.source(1, 2), "int a = 1;\n")
+    test_assert(p.source(-3), "int e[] = { foo(1,\n    2), [3] };\nint f = (\")\" + [4]);\n")
+    test_assert(p.source(), expected.source())
+
+    # Tables shared by many lines are copied rather than the lines being expanded
+    source = "".join("#define D{0} {0}\nint a{0} = D{0};\nint b{0} = D{0};\n".format(i) for i in range(100))
+    expected = Preprocessor()
+    expected.include("source.c", source)
+    p = Preprocessor()
+    p.lazy_expansion = True
+    p.include("source.c", source)
+    test_assert(p.source(), expected.source())
+
+    # Lines already read are not expanded again when the macros change
+    p = Preprocessor()
+    for i in range(100):
+        p.define("M{}".format(i), str(i))
+    p.lazy_expansion = True
+    p.include("source.c", "int a = M1;\n")
+    test_assert(p.source(), "int a = 1;\n")
+    expansions = p.macro_expansions
+    p.define("M1", "2")
+    test_assert(p.macro_expansions, expansions)
+
+    # Snapshots and streamed sources are unaffected
+    p = Preprocessor()
+    p.lazy_expansion = True
+    p.include("prelude.h", "#define A 1\nint a = A;\n")
+    state = p.snapshot()
+    p.define("A", "2")
+    unit = p.fork(state)
+    unit.include("source.c", "int b = A;\n")
+    test_assert(unit.source(), "int a = 1;\nint b = 1;\n")
+    test_assert(p.source(), "int a = 1;\n")
+    test_assert(list(p.iter_source("source.c", "int c = A;\n")), ["int c = 2;\n"])
+    # streamed lines are expanded as they are yielded, so none are kept pending
+    test_assert(len(list(p.iter_source("stream.c", "int s = A;\n" * 1000))), 1000)
+    test_assert(len(p._deferred_pending), 0)
+    test_assert(unit.lazy_expansion, True)
+    p.ignore_missing_includes = True
+    path = os.path.join(SRC_PATH, "usb", "USB_CTL.c")
+    config = p._batch_config()
+    test_assert(config["lazy_expansion"], True)
+    expected = Preprocessor()
+    expected.ignore_missing_includes = True
+    expected.define("A", "2")
+    expected.include(path)
+    test_assert(p.preprocess_batch([path], processes = 1)[0].source, expected.source())
+
+    # Files are expanded the same way as they would be immediately
+    for path in ["usb/USB_CTL.c", "usb/cdc/USB_CDC.c"]:
+        sources = []
+        for lazy in [False, True]:
+            p = Preprocessor()
+            p.ignore_missing_includes = True
+            p.add_include_path(SRC_PATH)
+            p.define("USB_CLASS_CDC")
+            p.lazy_expansion = lazy
+            p.include(path)
+            sources.append(p.source())
+        test_assert(sources[1], sources[0])
+
 # Run all the tests
 def run_tests():
     test_macro_evaluation()
@@ -298,6 +1311,30 @@ def run_tests():
     test_usb_class_msc()
     test_usb_class_cdc()
     test_include_source()
+    test_expansion_engines()
+    test_include_cache()
+    test_include_guards()
+    test_custom_directives()
+    test_skipped_blocks()
+    test_c_expressions()
+    test_expansion_cache()
+    test_iter_source()
+    test_preprocess_batch()
+    test_snapshot()
+    test_file_encoding()
+    test_profiling()
+    test_path_cache()
+    test_watcher()
+    test_dependencies()
+    test_macros_only()
+    test_macro_templates()
+    test_macro_operators()
+    test_source_map()
+    test_comments()
+    test_include_async()
+    test_file_providers()
+    test_macro_queries()
+    test_lazy_expansion()
 
 if __name__ == "__main__":
     run_tests()